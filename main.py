@@ -1,12 +1,26 @@
 
-import os, json, time, asyncio, logging, re, html, base64
-from typing import Any, Dict, Optional, List, Tuple
+import os, time, asyncio, logging, re, base64, threading, sqlite3, hashlib, secrets
+from types import MappingProxyType
+from typing import Any, Collection, Dict, Iterable, Iterator, Mapping, Optional, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import chain
 from urllib.parse import urlparse, quote
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+import ijson
+import orjson
+try:
+    import uvloop  # optional: faster event loop where available (not on Windows)
+except ImportError:
+    uvloop = None
 
 from flask import Flask
+from prometheus_client import Counter, Gauge, Histogram, make_wsgi_app
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
-from telegram.error import Conflict
+from telegram.error import BadRequest, Conflict, TelegramError
 from telegram.ext import (
     Application, ApplicationBuilder,
     CommandHandler, CallbackQueryHandler,
@@ -25,12 +39,23 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 TONAPI_KEY = os.getenv("TONAPI_KEY", "").strip()
 TONAPI_BASE = os.getenv("TONAPI_BASE", "https://tonapi.io").strip().rstrip("/")
 POLL_INTERVAL = max(2.0, float(os.getenv("POLL_INTERVAL", "2.0")))
+POLL_MAX_INTERVAL = max(POLL_INTERVAL, float(os.getenv("POLL_MAX_INTERVAL", "60")))
+POLL_CONCURRENCY = max(1, int(os.getenv("POLL_CONCURRENCY", "8")))
 BURST_WINDOW_SEC = int(os.getenv("BURST_WINDOW_SEC", "30"))
 DTRADE_REF = os.getenv("DTRADE_REF", "https://t.me/dtrade?start=11TYq7LInG").strip()
+DTRADE_BUY_BASE = (DTRADE_REF or "https://t.me/dtrade?start=11TYq7LInG").rstrip("_")
+DTRADE_BUY_PREFIX = DTRADE_BUY_BASE + "_"  # + jetton address
 TRENDING_URL = os.getenv("TRENDING_URL", "https://t.me/SpyTonTrending").strip()
 DEFAULT_TOKEN_TG = os.getenv("DEFAULT_TOKEN_TG", "https://t.me/SpyTonEco").strip()
 GECKO_BASE = os.getenv("GECKO_BASE", "https://api.geckoterminal.com/api/v2").strip().rstrip("/")
 
+# Webhook mode (optional): public https base URL Telegram should push updates to.
+# Unset = long polling, as before.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+
+DB_FILE = os.getenv("DB_FILE", "spyton_public.db")
+# legacy JSON state, imported into DB_FILE once on first start
 DATA_FILE = os.getenv("GROUPS_FILE", "groups_public.json")
 SEEN_FILE = os.getenv("SEEN_FILE", "seen_public.json")
 
@@ -38,17 +63,120 @@ SEEN_FILE = os.getenv("SEEN_FILE", "seen_public.json")
 DEX_TOKEN_URL = os.getenv("DEX_TOKEN_URL", "https://api.dexscreener.com/latest/dex/tokens").rstrip("/")
 DEX_PAIR_URL = os.getenv("DEX_PAIR_URL", "https://api.dexscreener.com/latest/dex/pairs").rstrip("/")
 
+# -------------------- HTTP --------------------
+# One pooled session for every upstream so TCP/TLS connections are reused across polls.
+# No adapter-level retries: callers own their retry policy (e.g. _tonapi_get_raw's loop),
+# and urllib3's uncapped Retry-After sleeps would otherwise run while a caller holds a
+# rate slot, and stretch tight per-call timeouts like the Dexscreener lookup's.
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=0)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"User-Agent": "SpyTONBuyBot/1.0", "Accept": "application/json", "Connection": "keep-alive"})
+# Worker threads for the blocking HTTP helpers (_to_thread). asyncio's default pool is
+# min(32, cpus + 4), i.e. 5 threads on a 1-vCPU container, which would queue polls behind
+# each other long before the connection pool above is used up.
+HTTP_WORKERS = max(4, int(os.getenv("HTTP_WORKERS", "32")))
+
+# key -> [done event, result, exception] for fetches currently in flight
+_INFLIGHT: Dict[str, list] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+def _flight_key(url: str, params: Optional[Dict[str, Any]] = None) -> str:
+    return url + ("?" + "&".join(f"{k}={params[k]}" for k in sorted(params)) if params else "")
+
+def _coalesce(key: str, fn):
+    """Run fn() once for concurrent callers with the same key; the others wait and share its result.
+
+    Helpers run in worker threads (see _to_thread), so groups tracking the same token
+    would otherwise fire identical requests in parallel.
+    """
+    with _INFLIGHT_LOCK:
+        call = _INFLIGHT.get(key)
+        leader = call is None
+        if leader:
+            call = _INFLIGHT[key] = [threading.Event(), None, None]
+    if not leader:
+        call[0].wait()
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+    try:
+        call[1] = fn()
+        return call[1]
+    except BaseException as e:
+        call[2] = e
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+        call[0].set()
+
+# -------------------- METRICS --------------------
+HTTP_REQUESTS = Counter("spyton_http_requests_total", "Outbound HTTP requests", ["upstream", "status"])
+STON_REQUEST_LATENCY = Histogram("spyton_ston_request_seconds", "STON export request latency", ["endpoint"])
+STON_HEAD_BLOCK = Gauge("spyton_ston_last_block", "Latest STON export block seen")
+
+def _http_get(upstream: str, url: str, **kwargs) -> requests.Response:
+    """SESSION.get counted in HTTP_REQUESTS under `upstream` (by status code, or "error")."""
+    try:
+        r = SESSION.get(url, **kwargs)
+    except requests.RequestException:
+        HTTP_REQUESTS.labels(upstream, "error").inc()
+        raise
+    HTTP_REQUESTS.labels(upstream, r.status_code).inc()
+    return r
+
+def _shared_get(upstream: str, url: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> requests.Response:
+    """_http_get where concurrent identical GETs (same url+params) share one response."""
+    return _coalesce(_flight_key(url, params), lambda: _http_get(upstream, url, params=params, **kwargs))
 
 # -------------------- STON API (exported events) --------------------
 STON_BASE = os.getenv("STON_BASE", "https://api.ston.fi").rstrip("/")
 STON_LATEST_BLOCK_URL = f"{STON_BASE}/export/dexscreener/v1/latest-block"
 STON_EVENTS_URL = f"{STON_BASE}/export/dexscreener/v1/events"
-STON_HEADERS = {
+# block numbers are plain ints, so the query string never needs escaping
+_STON_EVENTS_QUERY = STON_EVENTS_URL + "?fromBlock={}&toBlock={}"
+# built once (read-only), like the TonAPI headers
+STON_HEADERS: Mapping[str, str] = MappingProxyType({
     "User-Agent": "Mozilla/5.0",
     "Accept": "application/json,text/plain,*/*",
     "Accept-Language": "en-US,en;q=0.9",
-}
+})
+# catch-up windows are split into sub-requests of this many blocks, fetched concurrently
+STON_EVENTS_STEP = max(1, int(os.getenv("STON_EVENTS_STEP", "20")))
+STON_EVENTS_CONCURRENCY = 4
+# most blocks one cursor catches up on at once. Sized well above what a group backed off to
+# POLL_MAX_INTERVAL falls behind (TON produces a block every few seconds at most), so it only
+# bounds the pull after a real outage; anything older is skipped with a warning.
+STON_MAX_CATCHUP_BLOCKS = max(60, int(os.getenv("STON_MAX_CATCHUP_BLOCKS", str(max(600, int(POLL_MAX_INTERVAL * 10))))))
 STON_LAST_BLOCK: Optional[int] = None
+# validators from the last 200 latest-block response (sent back as If-None-Match / If-Modified-Since)
+_ston_latest_etag: str = ""
+_ston_latest_modified: str = ""
+
+def _parse_ston_latest_block(js: Any) -> Optional[int]:
+    # Primary format
+    if isinstance(js, dict) and isinstance(js.get("block"), dict):
+        v = js["block"].get("blockNumber") or js["block"].get("block_number")
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
+
+    # Other common variants
+    if isinstance(js, dict):
+        v = js.get("latestBlock") or js.get("latest_block") or js.get("block")
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
+
+    if isinstance(js, int):
+        return js
+    if isinstance(js, str) and js.isdigit():
+        return int(js)
+    return None
 
 def ston_latest_block() -> Optional[int]:
     """Return the latest exported block number from STON.fi export feed.
@@ -56,59 +184,114 @@ def ston_latest_block() -> Optional[int]:
     The API sometimes returns:
       {"block": {"blockNumber": 123}}
     or other variants. We normalize safely.
+
+    Polled every tick, so the request is conditional: when the head hasn't
+    moved the server answers 304 and we return the cached block.
     """
+    global STON_LAST_BLOCK, _ston_latest_etag, _ston_latest_modified
+    headers: Mapping[str, str] = STON_HEADERS
+    if STON_LAST_BLOCK is not None and (_ston_latest_etag or _ston_latest_modified):
+        # copy only when there are validators to add
+        headers = dict(STON_HEADERS)
+        if _ston_latest_etag:
+            headers["If-None-Match"] = _ston_latest_etag
+        if _ston_latest_modified:
+            headers["If-Modified-Since"] = _ston_latest_modified
     try:
-        r = requests.get(STON_LATEST_BLOCK_URL, headers=STON_HEADERS, timeout=12)
+        with STON_REQUEST_LATENCY.labels("latest-block").time():
+            r = SESSION.get(STON_LATEST_BLOCK_URL, headers=headers, timeout=12)
+        HTTP_REQUESTS.labels("ston", r.status_code).inc()
+        if r.status_code == 304:
+            return STON_LAST_BLOCK
         if r.status_code != 200:
+            log.warning("STON latest-block %s -> HTTP %s", STON_LATEST_BLOCK_URL, r.status_code)
             return None
-        js = r.json()
+        block = _parse_ston_latest_block(orjson.loads(r.content))
+        if block is not None:
+            STON_LAST_BLOCK = block
+            STON_HEAD_BLOCK.set(block)
+            _ston_latest_etag = r.headers.get("ETag") or ""
+            _ston_latest_modified = r.headers.get("Last-Modified") or ""
+        return block
+    except (requests.RequestException, ValueError) as e:
+        HTTP_REQUESTS.labels("ston", "error").inc()
+        log.warning("STON latest-block %s failed: %s", STON_LATEST_BLOCK_URL, e)
+        return None
 
-        # Primary format
-        if isinstance(js, dict) and isinstance(js.get("block"), dict):
-            v = js["block"].get("blockNumber") or js["block"].get("block_number")
-            try:
-                return int(v)
-            except Exception:
-                return None
+def _iter_json_objects(raw, key: str) -> Iterator[Dict[str, Any]]:
+    """Stream the objects of a JSON list body one at a time.
 
-        # Other common variants
-        if isinstance(js, dict):
-            v = js.get("latestBlock") or js.get("latest_block") or js.get("block")
-            try:
-                return int(v)
-            except Exception:
-                return None
+    Handles both shapes the APIs return: a bare list, or {key: [...]}.
+    """
+    roots = ("item", key + ".item")
+    builder = None
+    root = ""
+    for prefix, event, value in ijson.parse(raw, use_float=True):
+        if builder is None:
+            if event == "start_map" and prefix in roots:
+                builder = ijson.ObjectBuilder()
+                root = prefix
+                builder.event(event, value)
+            continue
+        builder.event(event, value)
+        if event == "end_map" and prefix == root:
+            yield builder.value
+            builder = None
 
-        if isinstance(js, int):
-            return js
-        if isinstance(js, str) and js.isdigit():
-            return int(js)
-        return None
-    except Exception:
-        return None
+def _ston_iter_events(raw) -> Iterator[Dict[str, Any]]:
+    """Stream event dicts out of a STON export body, one at a time."""
+    return _iter_json_objects(raw, "events")
 
-def ston_events(from_block: int, to_block: int) -> Optional[List[Dict[str, Any]]]:
+def ston_events(from_block: int, to_block: int, pools: Optional[Collection[str]] = None) -> Optional[List[Dict[str, Any]]]:
     """Fetch STON.fi export events.
 
+    The body is stream-parsed so a wide block window never sits in memory as a
+    whole; when `pools` is given only events whose pairId is in it are kept.
+
     Returns:
       - list of event dicts on success
       - None on HTTP/parse failure (so callers don't advance cursors and skip buys)
     """
-    params = {"fromBlock": int(from_block), "toBlock": int(to_block)}
+    url = _STON_EVENTS_QUERY.format(int(from_block), int(to_block))
     try:
-        r = requests.get(STON_EVENTS_URL, params=params, headers=STON_HEADERS, timeout=20)
-        if r.status_code != 200:
-            return None
-        js = r.json()
-        if isinstance(js, list):
-            return [x for x in js if isinstance(x, dict)]
-        if isinstance(js, dict) and isinstance(js.get("events"), list):
-            return [x for x in js["events"] if isinstance(x, dict)]
-        return []
-    except Exception:
+        with STON_REQUEST_LATENCY.labels("events").time():
+            with SESSION.get(url, headers=STON_HEADERS, timeout=20, stream=True) as r:
+                HTTP_REQUESTS.labels("ston", r.status_code).inc()
+                if r.status_code != 200:
+                    log.warning("STON events %s -> HTTP %s", url, r.status_code)
+                    return None
+                # body is read straight off r.raw, so transport errors surface as urllib3's, not requests'
+                r.raw.decode_content = True
+                out: List[Dict[str, Any]] = []
+                for ev in _ston_iter_events(r.raw):
+                    if pools is not None and str(ev.get("pairId") or "").strip() not in pools:
+                        continue
+                    out.append(ev)
+                return out
+    except (requests.RequestException, urllib3.exceptions.HTTPError, ValueError, ijson.JSONError) as e:
+        HTTP_REQUESTS.labels("ston", "error").inc()
+        log.warning("STON events %s failed: %s", url, e)
+        return None
+
+async def ston_events_range(from_block: int, to_block: int, pools: Optional[Collection[str]] = None,
+                            step: int = STON_EVENTS_STEP) -> Optional[List[Dict[str, Any]]]:
+    """`ston_events` over [from_block, to_block] as bounded sub-requests run concurrently.
+
+    Returns None if any slice fails, so the caller keeps its cursor and retries the window.
+    """
+    ranges = [(a, min(a + step - 1, to_block)) for a in range(from_block, to_block + 1, step)]
+    sem = asyncio.Semaphore(STON_EVENTS_CONCURRENCY)
+
+    async def fetch(a: int, b: int) -> Optional[List[Dict[str, Any]]]:
+        async with sem:
+            return await _to_thread(ston_events, a, b, pools)
+
+    parts = await asyncio.gather(*(fetch(a, b) for a, b in ranges))
+    if any(p is None for p in parts):
         return None
+    return list(chain.from_iterable(parts))
 
-def ensure_ton_leg_for_pool(token: Dict[str, Any]) -> Optional[int]:
+async def ensure_ton_leg_for_pool(token: Dict[str, Any]) -> Optional[int]:
     # cache 0/1 where TON is leg0(amount0*) or leg1(amount1*)
     tl = token.get("ton_leg")
     if tl in (0,1):
@@ -116,17 +299,13 @@ def ensure_ton_leg_for_pool(token: Dict[str, Any]) -> Optional[int]:
     pool = token.get("ston_pool")
     if not pool:
         return None
-    meta = _dex_pair_lookup(pool)
-    if not isinstance(meta, dict):
+    meta = await dex_pair_lookup(pool)
+    if meta is None:
         return None
-    base = (meta.get("baseToken") or {})
-    quote = (meta.get("quoteToken") or {})
-    base_sym = str(base.get("symbol") or "").upper()
-    quote_sym = str(quote.get("symbol") or "").upper()
-    if base_sym in ("TON","WTON"):
+    if meta.base_sym in _TON_SYMBOLS:
         token["ton_leg"] = 0
         return 0
-    if quote_sym in ("TON","WTON"):
+    if meta.quote_sym in _TON_SYMBOLS:
         token["ton_leg"] = 1
         return 1
     return None
@@ -134,47 +313,116 @@ def ensure_ton_leg_for_pool(token: Dict[str, Any]) -> Optional[int]:
 # -------------------- DEDUST API (for pool discovery + trades) --------------------
 DEDUST_API = os.getenv("DEDUST_API", "https://api.dedust.io").rstrip("/")
 
-_DEDUST_POOLS_CACHE = {"ts": 0, "data": None}
+_DEDUST_POOLS_CACHE = {"ts": 0, "data": None, "etag": "", "modified": ""}
+# token address -> (best TON pool address, its liquidity); rebuilt with the pools cache
+_DEDUST_TON_INDEX: Dict[str, Tuple[str, float]] = {}
+
+def dedust_get_pools() -> List[Tuple[str, str, float]]:
+    """Fetch DeDust's pool list and keep its TON pools as (token, pool, liquidity_usd) rows.
 
-def dedust_get_pools() -> List[Dict[str, Any]]:
-    """Fetch available pools from DeDust API. Cached to avoid heavy downloads."""
+    Cached to avoid heavy downloads. Only the TON pools survive parsing, so the raw
+    (multi-MB) list is not kept in memory between refreshes.
+    """
     now = int(time.time())
     if _DEDUST_POOLS_CACHE["data"] is not None and now - int(_DEDUST_POOLS_CACHE["ts"] or 0) < 3600:
         return _DEDUST_POOLS_CACHE["data"] or []
+    # conditional refresh: an unchanged list comes back as an empty 304
+    headers: Dict[str, str] = {}
+    if _DEDUST_POOLS_CACHE["data"] is not None:
+        if _DEDUST_POOLS_CACHE["etag"]:
+            headers["If-None-Match"] = _DEDUST_POOLS_CACHE["etag"]
+        if _DEDUST_POOLS_CACHE["modified"]:
+            headers["If-Modified-Since"] = _DEDUST_POOLS_CACHE["modified"]
     try:
-        r = requests.get(f"{DEDUST_API}/v2/pools", timeout=25)
-        if r.status_code != 200:
-            return _DEDUST_POOLS_CACHE["data"] or []
-        js = r.json()
-        pools = js.get("pools") if isinstance(js, dict) else js
-        if not isinstance(pools, list):
-            pools = []
+        with _http_get("dedust", f"{DEDUST_API}/v2/pools", headers=headers, timeout=25, stream=True) as r:
+            if r.status_code == 304:
+                _DEDUST_POOLS_CACHE["ts"] = now
+                return _DEDUST_POOLS_CACHE["data"] or []
+            if r.status_code != 200:
+                return _DEDUST_POOLS_CACHE["data"] or []
+            # stream-parsed: one pool object alive at a time instead of the whole multi-MB list
+            r.raw.decode_content = True
+            rows = _dedust_ton_pools(_iter_json_objects(r.raw, "pools"))
         _DEDUST_POOLS_CACHE["ts"] = now
-        _DEDUST_POOLS_CACHE["data"] = pools
-        return pools
+        _DEDUST_POOLS_CACHE["data"] = rows
+        _DEDUST_POOLS_CACHE["etag"] = r.headers.get("ETag") or ""
+        _DEDUST_POOLS_CACHE["modified"] = r.headers.get("Last-Modified") or ""
+        _rebuild_dedust_ton_index(rows)
+        return rows
     except Exception:
         return _DEDUST_POOLS_CACHE["data"] or []
 
+_TON_ASSET_TYPES = frozenset(("native", "ton"))
+_TON_SYMBOLS = frozenset(("TON", "WTON"))
+
 def _dedust_is_ton_asset(asset: Any) -> bool:
     if not isinstance(asset, dict):
         return False
-    t = (asset.get("type") or asset.get("kind") or "").lower()
-    # common representations
-    if t in ("native", "ton"):
+    t = asset.get("type") or asset.get("kind") or ""
+    # common representations (API sends lowercase; only normalize when it doesn't)
+    if t in _TON_ASSET_TYPES or (t and t.lower() in _TON_ASSET_TYPES):
         return True
     # sometimes TON shown as jetton with empty address
-    sym = (asset.get("symbol") or "").upper()
-    if sym in ("TON","WTON"):
-        return True
-    addr = (asset.get("address") or "").strip()
+    sym = asset.get("symbol")
     # TON has no jetton master address; keep conservative
-    return False
+    return bool(sym) and sym.upper() in _TON_SYMBOLS
 
 def _dedust_asset_addr(asset: Any) -> str:
     if not isinstance(asset, dict):
         return ""
     return str(asset.get("address") or asset.get("master") or asset.get("jetton") or "").strip()
 
+def _dedust_ton_pools(pools: Iterable[Any]) -> List[Tuple[str, str, float]]:
+    """(token address, pool address, liquidity) for every TON/jetton pool in a raw DeDust list."""
+    rows: List[Tuple[str, str, float]] = []
+    is_ton = _dedust_is_ton_asset
+    asset_addr = _dedust_asset_addr
+    for p in pools:
+        if type(p) is not dict:
+            continue
+        assets = p.get("assets") or p.get("tokens") or p.get("reserves")
+        if not assets:
+            continue
+        # assets might be dict with keys a/b
+        if type(assets) is dict:
+            assets = list(assets.values())
+        elif type(assets) is not list:
+            continue
+        if len(assets) < 2:
+            continue
+        a0, a1 = assets[0], assets[1]
+        # Determine TON side (most pools are jetton/jetton and drop out here)
+        if is_ton(a0):
+            tok_side_addr = asset_addr(a1)
+        elif is_ton(a1):
+            tok_side_addr = asset_addr(a0)
+        else:
+            continue
+        if not tok_side_addr:
+            continue
+        addr = str(p.get("address") or p.get("pool") or p.get("id") or "").strip()
+        if not addr:
+            continue
+        # liquidity score if available
+        try:
+            liq = float(p.get("liquidityUsd") or p.get("liquidity_usd") or p.get("tvlUsd") or 0.0)
+        except Exception:
+            liq = 0.0
+        rows.append((tok_side_addr, addr, liq))
+    return rows
+
+def _rebuild_dedust_ton_index(rows: List[Tuple[str, str, float]]) -> None:
+    """Index TON pools by their non-TON token, keeping the most liquid pool per token."""
+    index: Dict[str, Tuple[str, float]] = {}
+    for tok, addr, liq in rows:
+        # keyed by canonical address so an EQ../UQ.. spelling difference can't miss
+        tok = _canon_addr(tok)
+        best = index.get(tok)
+        if best is None or liq > best[1]:
+            index[tok] = (addr, liq)
+    _DEDUST_TON_INDEX.clear()
+    _DEDUST_TON_INDEX.update(index)
+
 def find_dedust_ton_pair_for_token(token_address: str) -> Optional[str]:
     """Find DeDust pool address for TON <-> token.
 
@@ -193,56 +441,17 @@ def find_dedust_ton_pair_for_token(token_address: str) -> Optional[str]:
     except Exception:
         pass
     try:
-        pools = dedust_get_pools()
-        best_pool = None
-        best_liq = -1.0
-        for p in pools:
-            if not isinstance(p, dict):
-                continue
-            addr = str(p.get("address") or p.get("pool") or p.get("id") or "").strip()
-            if not addr:
-                continue
-            assets = p.get("assets") or p.get("tokens") or p.get("reserves") or []
-            # assets might be dict with keys a/b
-            if isinstance(assets, dict):
-                assets = list(assets.values())
-            if not isinstance(assets, list) or len(assets) < 2:
-                continue
-            a0, a1 = assets[0], assets[1]
-            # Determine TON side
-            ton_side = None
-            tok_side_addr = ""
-            if _dedust_is_ton_asset(a0):
-                ton_side = 0
-                tok_side_addr = _dedust_asset_addr(a1)
-            elif _dedust_is_ton_asset(a1):
-                ton_side = 1
-                tok_side_addr = _dedust_asset_addr(a0)
-            else:
-                continue
-            if not tok_side_addr:
-                continue
-            if tok_side_addr != ta:
-                continue
-            # liquidity score if available
-            liq = 0.0
-            try:
-                liq = float(p.get("liquidityUsd") or p.get("liquidity_usd") or p.get("tvlUsd") or 0.0)
-            except Exception:
-                liq = 0.0
-            if liq > best_liq:
-                best_liq = liq
-                best_pool = addr
-        return best_pool
+        dedust_get_pools()  # refreshes the index when the cache is stale
+        return _DEDUST_TON_INDEX.get(_canon_addr(ta), (None,))[0]
     except Exception:
         return None
 
 def dedust_get_trades(pool: str, limit: int = 20) -> List[Dict[str, Any]]:
     try:
-        r = requests.get(f"{DEDUST_API}/v2/pools/{pool}/trades", params={"limit": limit}, timeout=25)
+        r = _http_get("dedust", f"{DEDUST_API}/v2/pools/{pool}/trades", params={"limit": limit}, timeout=25)
         if r.status_code != 200:
             return []
-        js = r.json()
+        js = orjson.loads(r.content)
         trades = js.get("trades") if isinstance(js, dict) else js
         if not isinstance(trades, list):
             return []
@@ -250,20 +459,84 @@ def dedust_get_trades(pool: str, limit: int = 20) -> List[Dict[str, Any]]:
     except Exception:
         return []
 
-def dedust_trade_to_buy(tr: Dict[str, Any], token_addr: str) -> Optional[Dict[str, Any]]:
-    """Convert a DeDust trade item to our buy dict if it's TON -> token."""
+@dataclass(slots=True)
+class Trade:
+    """A parsed TON -> token buy, whatever source it came from."""
+    tx: str
+    buyer: str
+    ton: Optional[float]
+    token_amount: Optional[float]
+    trade_id: str = ""
+
+def _first(d: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    """First truthy d[k] over keys (same result as a `d.get(a) or d.get(b) or ...` chain)."""
+    for k in keys:
+        v = d.get(k)
+        if v:
+            return v
+    return None
+
+# alias tuple -> the key that answered last time. Each API version spells a field one way,
+# so steady state is one probe instead of walking the alias list.
+_FIELD_CHOICE: Dict[Tuple[str, ...], str] = {}
+
+def _first_learned(d: Dict[str, Any], keys: Tuple[str, ...]) -> Any:
+    """_first, trying the alias that matched last time before the full (re-learning) walk.
+
+    Only for interchangeable spellings (amounts, assets): ids and tx hashes feed dedupe
+    keys and keep _first's strict preference order.
+    """
+    k = _FIELD_CHOICE.get(keys)
+    if k is not None:
+        v = d.get(k)
+        if v:
+            return v
+    for k in keys:
+        v = d.get(k)
+        if v:
+            _FIELD_CHOICE[keys] = k
+            return v
+    return None
+
+# field aliases seen across DeDust API versions, in order of preference
+DEDUST_TX_FIELDS = ("tx", "txHash", "hash", "transaction")
+DEDUST_BUYER_FIELDS = ("sender", "trader", "maker", "wallet")
+DEDUST_ID_FIELDS = ("id", "tradeId", "lt", "seqno")
+DEDUST_ASSET_IN_FIELDS = ("assetIn", "inAsset", "fromAsset", "in")
+DEDUST_ASSET_OUT_FIELDS = ("assetOut", "outAsset", "toAsset", "out")
+DEDUST_AMOUNT_IN_FIELDS = ("amountIn", "inAmount", "amount_in", "amountInJettons", "amount_in_wei", "in")
+DEDUST_AMOUNT_OUT_FIELDS = ("amountOut", "outAmount", "amount_out", "amountOutJettons", "out")
+
+# amounts above this are taken to be in minimal units (nanoTON / raw jetton units)
+_RAW_AMOUNT_ABOVE = 1e8
+
+def _normalize_buy_amounts(
+    ton: float, token_amt: float, decimals: Optional[int], ton_raw_above: float = _RAW_AMOUNT_ABOVE
+) -> Tuple[float, float]:
+    """Scale a buy's (TON, jetton) amounts to human units when they look raw.
+
+    Jetton amounts are only scaled when decimals are known.
+    """
+    if ton > ton_raw_above:
+        ton /= 1e9
+    if decimals is not None and token_amt > _RAW_AMOUNT_ABOVE:
+        token_amt /= 10 ** decimals
+    return ton, token_amt
+
+def dedust_trade_to_buy(tr: Dict[str, Any], token_addr: str) -> Optional[Trade]:
+    """Convert a DeDust trade item to a Trade if it's TON -> token."""
     if not isinstance(tr, dict):
         return None
     # common fields guesses
-    tx = str(tr.get("tx") or tr.get("txHash") or tr.get("hash") or tr.get("transaction") or "").strip()
-    buyer = str(tr.get("sender") or tr.get("trader") or tr.get("maker") or tr.get("wallet") or "").strip()
-    trade_id = str(tr.get("id") or tr.get("tradeId") or tr.get("lt") or tr.get("seqno") or tx).strip()
+    tx = str(_first(tr, DEDUST_TX_FIELDS) or "").strip()
+    buyer = str(_first(tr, DEDUST_BUYER_FIELDS) or "").strip()
+    trade_id = str(_first(tr, DEDUST_ID_FIELDS) or tx).strip()
     # asset in/out objects
-    ain = tr.get("assetIn") or tr.get("inAsset") or tr.get("fromAsset") or tr.get("in") or {}
-    aout = tr.get("assetOut") or tr.get("outAsset") or tr.get("toAsset") or tr.get("out") or {}
+    ain = _first_learned(tr, DEDUST_ASSET_IN_FIELDS) or {}
+    aout = _first_learned(tr, DEDUST_ASSET_OUT_FIELDS) or {}
     # amounts
-    amt_in = tr.get("amountIn") or tr.get("inAmount") or tr.get("amount_in") or tr.get("amountInJettons") or tr.get("amount_in_wei") or tr.get("in") or None
-    amt_out = tr.get("amountOut") or tr.get("outAmount") or tr.get("amount_out") or tr.get("amountOutJettons") or tr.get("out") or None
+    amt_in = _first_learned(tr, DEDUST_AMOUNT_IN_FIELDS)
+    amt_out = _first_learned(tr, DEDUST_AMOUNT_OUT_FIELDS)
 
     # Some APIs nest amounts with decimals
     def _as_float(x):
@@ -282,31 +555,21 @@ def dedust_trade_to_buy(tr: Dict[str, Any], token_addr: str) -> Optional[Dict[st
     out_addr = _dedust_asset_addr(aout)
     if not is_ton_in:
         return None
-    if out_addr != token_addr:
+    if not _same_addr(out_addr, _canon_addr(token_addr)):
         return None
 
-    # TON amount is in TON (API usually already human). If API returns nano, it will be huge; we guard:
-    ton_amt = amt_in_f
-    if ton_amt > 1e8:  # looks like nanoTON
-        ton_amt = ton_amt / 1e9
-
-    token_amt = amt_out_f
-    # DeDust API sometimes returns jetton amount in minimal units (integer-like).
-    # Convert using jetton decimals when it looks too large.
-    try:
-        dec = int(get_jetton_meta(token_addr).get("decimals") or 9)
-        if token_amt > 1e8:
-            token_amt = token_amt / (10 ** dec)
-    except Exception:
-        pass
+    # TON amount is in TON (API usually already human). If API returns nano, it will be huge.
+    # DeDust API sometimes returns jetton amount in minimal units (integer-like); only then
+    # are the jetton decimals needed.
+    dec: Optional[int] = None
+    if amt_out_f > _RAW_AMOUNT_ABOVE:
+        try:
+            dec = int(get_jetton_meta(token_addr).get("decimals") or 9)
+        except Exception:
+            dec = None
+    ton_amt, token_amt = _normalize_buy_amounts(amt_in_f, amt_out_f, dec)
 
-    return {
-        "tx": tx or trade_id,
-        "buyer": buyer,
-        "ton": ton_amt,
-        "token_amount": token_amt,
-        "trade_id": trade_id,
-    }
+    return Trade(tx=tx or trade_id, buyer=buyer, ton=ton_amt, token_amount=token_amt, trade_id=trade_id)
 
 
 # -------------------- DEDUST (TonAPI events fallback) --------------------
@@ -331,8 +594,9 @@ def dedust_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str, pool_addr
     """
     if not isinstance(ev, dict):
         return []
-    token_addr = str(token_addr or "").strip()
-    pool_addr = str(pool_addr or "").strip()
+    # canonical, so upstream addresses in any form compare with _same_addr
+    token_addr = _canon_addr(token_addr)
+    pool_addr = _canon_addr(pool_addr)
     if not token_addr or not pool_addr:
         return []
 
@@ -354,12 +618,12 @@ def dedust_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str, pool_addr
 
         jetton = jt.get("jetton") or {}
         jetton_addr = str((jetton.get("address") if isinstance(jetton, dict) else "") or "").strip()
-        if jetton_addr != token_addr:
+        if not _same_addr(jetton_addr, token_addr):
             continue
 
         recipient = jt.get("recipient") or {}
         buyer_addr = str((recipient.get("address") if isinstance(recipient, dict) else "") or "").strip()
-        if not buyer_addr or buyer_addr == pool_addr:
+        if not buyer_addr or _same_addr(buyer_addr, pool_addr):
             continue
 
         amt_raw = jt.get("amount")
@@ -412,7 +676,7 @@ def dedust_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str, pool_addr
         outgoing_by[sender_addr] = max(outgoing_by.get(sender_addr, 0.0), ton_amt)
 
         # Direct buyer -> pool transfer (best signal)
-        if recip_addr == pool_addr:
+        if _same_addr(recip_addr, pool_addr):
             ton_spent_by[sender_addr] = max(ton_spent_by.get(sender_addr, 0.0), ton_amt)
 
     # If we didn't find direct transfers to the pool, fall back to the biggest outgoing TON per buyer.
@@ -462,6 +726,70 @@ def dedust_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str, pool_addr
         })
     return buys
 
+# -------------------- TON ADDRESSES --------------------
+def _crc16_table() -> Tuple[int, ...]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = (((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+_CRC16_TABLE = _crc16_table()
+
+def _crc16_xmodem(data: bytes) -> int:
+    # table-driven: the DeDust index canonicalizes thousands of addresses per refresh
+    crc = 0
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+def _canon_addr(a: str) -> str:
+    """Bounceable (EQ..) form of a user-friendly or raw TON address; anything else is returned stripped.
+
+    UQ.., EQ.. and 0:<hex> spell the same account, so addresses are canonicalized wherever
+    they enter the bot and a plain string compare tells whether two tokens are the same.
+    """
+    a = (a or "").strip()
+    if len(a) != 48:
+        # raw "<workchain>:<64 hex>" form, as some TonAPI fields return it
+        wc, sep, h = a.partition(":")
+        if not sep or len(h) != 64 or wc not in ("0", "-1"):
+            return a
+        try:
+            body = bytes((0x11, int(wc) & 0xFF)) + bytes.fromhex(h)
+        except ValueError:
+            return a
+        return base64.urlsafe_b64encode(body + _crc16_xmodem(body).to_bytes(2, "big")).decode()
+    try:
+        raw = base64.urlsafe_b64decode(a.replace("+", "-").replace("/", "_"))
+    except (ValueError, TypeError):
+        return a
+    if len(raw) != 36 or _crc16_xmodem(raw[:34]) != int.from_bytes(raw[34:], "big"):
+        return a
+    # tag 0x11 = bounceable, 0x51 = non-bounceable; the 0x80 bit marks testnet
+    body = bytes((raw[0] & 0x80 | 0x11,)) + raw[1:34]
+    return base64.urlsafe_b64encode(body + _crc16_xmodem(body).to_bytes(2, "big")).decode()
+
+# upstream address -> canonical form, for _same_addr; the parsers see the same pool, user and
+# jetton addresses every poll. Bounded; the oldest entry is evicted first.
+_CANON_MEMO: Dict[str, str] = {}
+_CANON_MEMO_MAX = 8192
+
+def _same_addr(a: str, canon: str) -> bool:
+    """Whether upstream address `a` (any form) is the account `canon` (already canonical)."""
+    if a == canon:
+        return True
+    c = _CANON_MEMO.get(a)
+    if c is None:
+        c = _canon_addr(a)
+        if len(_CANON_MEMO) >= _CANON_MEMO_MAX:
+            _CANON_MEMO.pop(next(iter(_CANON_MEMO)), None)
+        _CANON_MEMO[a] = c
+    return c == canon
+
 # -------------------- STATE --------------------
 DEFAULT_SETTINGS = {
     "enable_ston": True,
@@ -494,45 +822,174 @@ DEFAULT_SETTINGS = {
 
 def _load_json(path: str, default):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     except Exception:
         return default
 
-def _save_json(path: str, obj):
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2, ensure_ascii=False)
-    os.replace(tmp, path)
+def _dumps(obj: Any) -> str:
+    # orjson emits compact UTF-8 (same as ensure_ascii=False); tolerate stray non-str keys
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+# -------------------- STORAGE (SQLite) --------------------
+# groups: one JSON row per chat; seen: one row per dedupe key. WAL keeps writes cheap,
+# so a change costs one row instead of rewriting the whole state file.
+SEEN_RETENTION_SEC = 3600  # seen rows older than this are swept (dedupe TTL is far shorter)
+SEEN_SWEEP_SEC = 60
+
+_DB_LOCK = threading.Lock()
+
+def _seen_key(key: str) -> bytes:
+    # dedupe keys ("ston:<pool>:<tx>", ...) run ~100+ chars; store a 16-byte digest instead,
+    # which keeps the seen table and its primary-key index small
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+def _db_open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS groups (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at INTEGER)"
+    )
+    # tables created before updated_at existed get the column added in place (NULL until next write)
+    if "updated_at" not in {r[1] for r in conn.execute("PRAGMA table_info(groups)")}:
+        conn.execute("ALTER TABLE groups ADD COLUMN updated_at INTEGER")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS seen (chat_id TEXT NOT NULL, key BLOB NOT NULL, ts INTEGER NOT NULL,"
+        " PRIMARY KEY (chat_id, key)) WITHOUT ROWID"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS seen_ts ON seen (ts)")
+    # account:lt -> tx hash; immutable, so it survives restarts instead of being rescanned
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS lt_hash (key TEXT PRIMARY KEY, ts INTEGER NOT NULL, hash TEXT NOT NULL) WITHOUT ROWID"
+    )
+    # user_version 0 = fresh DB: import the legacy JSON files once
+    if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+        groups = _load_json(DATA_FILE, {})
+        seen = _load_json(SEEN_FILE, {})
+        with conn:
+            if isinstance(groups, dict):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO groups (chat_id, data) VALUES (?, ?)",
+                    [(str(k), _dumps(v)) for k, v in groups.items() if isinstance(v, dict)],
+                )
+            if isinstance(seen, dict):
+                conn.executemany(
+                    "INSERT OR REPLACE INTO seen (chat_id, key, ts) VALUES (?, ?, ?)",
+                    [(str(c), _seen_key(str(k)), int(ts)) for c, b in seen.items() if isinstance(b, dict) for k, ts in b.items()],
+                )
+            conn.execute("PRAGMA user_version = 1")
+    return conn
+
+DB = _db_open(DB_FILE)
+
+def _db_load_groups() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for chat_id, data in DB.execute("SELECT chat_id, data FROM groups"):
+        try:
+            g = out[chat_id] = orjson.loads(data)
+        except ValueError:
+            log.warning("skipping unreadable group row %s", chat_id)
+            continue
+        # anti-spam counters used to be stored with the token; they live in _BURST_STATE now
+        tok = g.get("token") if isinstance(g, dict) else None
+        if isinstance(tok, dict):
+            tok.pop("burst", None)
+            # tokens configured before addresses were canonicalized may be stored as UQ../raw
+            if tok.get("address"):
+                tok["address"] = _canon_addr(tok["address"])
+    return out
+
+GROUPS: Dict[str, Any] = _db_load_groups()  # chat_id -> config (in-memory mirror of the groups table)
+# chat_id -> serialized row as last written, so save_groups() only touches changed chats
+_GROUPS_SAVED: Dict[str, str] = {k: _dumps(v) for k, v in GROUPS.items()}
 
-GROUPS: Dict[str, Any] = _load_json(DATA_FILE, {})  # chat_id -> config
-SEEN: Dict[str, Any] = _load_json(SEEN_FILE, {})    # chat_id -> {dedupe_key: ts}
+@dataclass(slots=True)
+class AwaitToken:
+    group_id: int
+    stage: str = "CA"
+    dex: str = "both"
 
-# user_id -> chat_id awaiting token paste
-AWAITING: Dict[int, Dict[str, Any]] = {}  # user_id -> {'group_id': int, 'stage': str, 'dex': str}
+@dataclass(slots=True)
+class AwaitSocial:
+    chat_id: int
+    field: str = "telegram"  # 'telegram'|'website'|'twitter'
 
-# user_id -> chat_id awaiting social link input
-AWAITING_SOCIAL: Dict[int, Dict[str, Any]] = {}  # {'chat_id': int, 'field': 'telegram'|'website'|'twitter'}
+# user_id -> group awaiting token paste
+AWAITING: Dict[int, AwaitToken] = {}
+
+# user_id -> chat awaiting social link input
+AWAITING_SOCIAL: Dict[int, AwaitSocial] = {}
 
 # user_id -> chat_id awaiting buy image photo
 AWAITING_IMAGE: Dict[int, int] = {}
 
 # -------------------- HELPERS --------------------
-JETTON_RE = re.compile(r"\b([EU]Q[A-Za-z0-9_-]{40,80})\b")
-GECKO_POOL_RE = re.compile(r"geckoterminal\.com/ton/pools/([A-Za-z0-9_-]{20,120})", re.IGNORECASE)
-DEXSCREENER_PAIR_RE = re.compile(r"dexscreener\.com/ton/([A-Za-z0-9_-]{20,120})", re.IGNORECASE)
-STON_POOL_RE = re.compile(r"ston\.fi/[^\s]*?(?:pool|pools)/([A-Za-z0-9_-]{20,120})", re.IGNORECASE)
-DEDUST_POOL_RE = re.compile(r"dedust\.(?:io|org)/[^\s]*?(?:pool|pools)/([A-Za-z0-9_-]{20,120})", re.IGNORECASE)
+# \w under re.ASCII, and the base64url alphabet of user-friendly addresses
+_WORD_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_")
+_B64URL_CHARS = _WORD_CHARS | {"-"}
+# Pool/pair links (GeckoTerminal, Dexscreener, ston.fi, dedust.io) and bare EQ/UQ ids in one
+# pattern; m.lastgroup says which alternative matched. Hostnames are case-insensitive, ids are not.
+LINK_RE = re.compile(
+    r"(?i:geckoterminal\.com/ton/pools/)(?P<gecko>[A-Za-z0-9_-]{20,120})"
+    r"|(?i:dexscreener\.com/ton/)(?P<dexs>[A-Za-z0-9_-]{20,120})"
+    r"|(?i:ston\.fi/[^\s]*?(?:pool|pools)/)(?P<ston>[A-Za-z0-9_-]{20,120})"
+    r"|(?i:dedust\.(?:io|org)/[^\s]*?(?:pool|pools)/)(?P<dedust>[A-Za-z0-9_-]{20,120})"
+    r"|\b(?P<jetton>[EU]Q[A-Za-z0-9_-]{40,80})\b",
+    re.ASCII,
+)
+# token Telegram links sent with (or instead of) a CA
+TG_LINK_RE = re.compile(r"https?://t\.me/[A-Za-z0-9_]{3,}\S*")
+# words that make a bare EQ/UQ id more likely to be a pool than a jetton
+POOL_HINT_RE = re.compile(r"pool|geckoterminal|dexscreener", re.IGNORECASE | re.ASCII)
 
 def is_private(update: Update) -> bool:
     return bool(update.effective_chat and update.effective_chat.type == "private")
 
+# (chat_id, user_id) -> (ts, is admin); admin rights rarely change between taps
+_ADMIN_CACHE: Dict[Tuple[int, int], Tuple[float, bool]] = {}
+_ADMIN_CACHE_MAX = 2048
+ADMIN_TTL = 30
+# group chat_id -> (ts, admin user ids): one getChatAdministrators answers every user in the chat
+_ADMIN_SETS: Dict[int, Tuple[float, frozenset]] = {}
+
+async def _chat_admin_ids(bot, chat_id: int) -> Optional[frozenset]:
+    hit = _ADMIN_SETS.get(chat_id)
+    if hit and time.time() - hit[0] < ADMIN_TTL:
+        return hit[1]
+    try:
+        admins = await bot.get_chat_administrators(chat_id)
+    except Exception:
+        return None
+    ids = frozenset(m.user.id for m in admins)
+    _ADMIN_SETS.pop(chat_id, None)
+    if len(_ADMIN_SETS) >= _ADMIN_CACHE_MAX:
+        _ADMIN_SETS.pop(next(iter(_ADMIN_SETS)), None)
+    _ADMIN_SETS[chat_id] = (time.time(), ids)
+    return ids
+
 async def is_admin(bot, chat_id: int, user_id: int) -> bool:
+    chat_id, user_id = int(chat_id), int(user_id)
+    # groups have negative ids; private chats have no admin list to fetch
+    if chat_id < 0:
+        ids = await _chat_admin_ids(bot, chat_id)
+        if ids is not None:
+            return user_id in ids
+    key = (chat_id, user_id)
+    hit = _ADMIN_CACHE.get(key)
+    if hit and time.time() - hit[0] < ADMIN_TTL:
+        return hit[1]
     try:
         m = await bot.get_chat_member(chat_id, user_id)
-        return m.status in ("administrator", "creator")
     except Exception:
+        # not cached: a transient API error shouldn't lock an admin out for ADMIN_TTL
         return False
+    ok = m.status in ("administrator", "creator")
+    _ADMIN_CACHE.pop(key, None)
+    if len(_ADMIN_CACHE) >= _ADMIN_CACHE_MAX:
+        _ADMIN_CACHE.pop(next(iter(_ADMIN_CACHE)), None)
+    _ADMIN_CACHE[key] = (time.time(), ok)
+    return ok
 
 def get_group(chat_id: int) -> Dict[str, Any]:
     key = str(chat_id)
@@ -545,18 +1002,195 @@ def get_group(chat_id: int) -> Dict[str, Any]:
     g.setdefault("created_at", int(time.time()))
     return g
 
+# Handlers only mark the config dirty; groups_flusher writes at most once per
+# GROUPS_FLUSH_SEC, so a burst of setting toggles costs one DB transaction.
+GROUPS_FLUSH_SEC = 0.5
+_GROUPS_DIRTY = {"v": False}
+
+def mark_groups_dirty() -> None:
+    _GROUPS_DIRTY["v"] = True
+
+def _groups_changes() -> Tuple[List[Tuple[str, str]], List[str]]:
+    """(changed rows, removed chat ids) since the last save; serialized on the caller's thread."""
+    changed = []
+    for k, g in GROUPS.items():
+        data = _dumps(g)
+        if _GROUPS_SAVED.get(k) != data:
+            changed.append((k, data))
+    removed = [k for k in _GROUPS_SAVED if k not in GROUPS]
+    return changed, removed
+
+def _write_groups(changed: List[Tuple[str, str]], removed: List[str]) -> None:
+    now = int(time.time())
+    with _DB_LOCK, DB:
+        DB.executemany(
+            "INSERT OR REPLACE INTO groups (chat_id, data, updated_at) VALUES (?, ?, ?)",
+            [(k, data, now) for k, data in changed],
+        )
+        DB.executemany("DELETE FROM groups WHERE chat_id = ?", [(k,) for k in removed])
+
+def _mark_groups_saved(changed: List[Tuple[str, str]], removed: List[str]) -> None:
+    _GROUPS_SAVED.update(changed)
+    for k in removed:
+        _GROUPS_SAVED.pop(k, None)
+
 def save_groups():
-    _save_json(DATA_FILE, GROUPS)
+    """Write the chats whose config changed since the last save (and drop removed ones) now."""
+    _GROUPS_DIRTY["v"] = False
+    changed, removed = _groups_changes()
+    if not changed and not removed:
+        return
+    _write_groups(changed, removed)
+    _mark_groups_saved(changed, removed)
+
+# one flush at a time, so an older snapshot can never land after a newer one
+_GROUPS_FLUSH_LOCK = asyncio.Lock()
+
+async def flush_groups() -> None:
+    """Write pending config changes now, off the loop (for changes that shouldn't wait for the flusher)."""
+    async with _GROUPS_FLUSH_LOCK:
+        _GROUPS_DIRTY["v"] = False
+        # snapshot on the loop (handlers mutate GROUPS there); only the DB write leaves it
+        changed, removed = _groups_changes()
+        if not changed and not removed:
+            return
+        try:
+            await _to_thread(_write_groups, changed, removed)
+        except Exception as e:
+            log.exception("groups flush failed: %s", e)
+            _GROUPS_DIRTY["v"] = True
+            return
+        _mark_groups_saved(changed, removed)
+
+async def groups_flusher():
+    while True:
+        await asyncio.sleep(GROUPS_FLUSH_SEC)
+        if _GROUPS_DIRTY["v"]:
+            await flush_groups()
+
+_SEEN_SWEEP = {"ts": 0}
+# key digest + chat_id bytes -> ts the dedupe key was marked seen. This is what dedupe_ok
+# answers from; the seen table only carries it across restarts (loaded below, written in
+# batches by save_seen). Entries older than SEEN_RETENTION_SEC are swept; the cap is a
+# safety net, evicting the oldest insert first. One flat bytes key instead of a
+# (str, bytes) tuple keeps an entry at ~130 bytes including its dict slot.
+_SEEN_RECENT_MAX = 100_000
+# guards the in-memory dedupe state only (never held across DB I/O), since dedupe_ok runs
+# on the event loop while warmup and save_seen touch it from worker threads
+_SEEN_LOCK = threading.Lock()
+# (chat_id, digest, ts) marked seen since the last flush; written once per poll cycle
+_SEEN_PENDING: List[Tuple[str, bytes, int]] = []
+
+def _db_load_seen() -> Dict[bytes, int]:
+    cutoff = int(time.time()) - SEEN_RETENTION_SEC
+    rows = DB.execute(
+        "SELECT chat_id, key, ts FROM seen WHERE ts > ? ORDER BY ts DESC LIMIT ?", (cutoff, _SEEN_RECENT_MAX)
+    ).fetchall()
+    # oldest first, matching insertion order
+    return {bytes(key) + c.encode(): int(ts) for c, key, ts in reversed(rows)}
+
+_SEEN_RECENT: Dict[bytes, int] = _db_load_seen()
+
+def _flush_seen() -> None:
+    if not _SEEN_PENDING:
+        return
+    # swap the list out first so keys marked during the write land in the next batch
+    batch = _SEEN_PENDING[:]
+    del _SEEN_PENDING[:len(batch)]
+    with _DB_LOCK, DB:
+        DB.executemany("INSERT OR REPLACE INTO seen (chat_id, key, ts) VALUES (?, ?, ?)", batch)
 
 def save_seen():
-    _save_json(SEEN_FILE, SEEN)
+    """Write the dedupe keys and LT->hash lookups found this cycle and sweep expired rows.
+
+    Called every poll cycle but only sweeps once per SEEN_SWEEP_SEC; the ts index makes
+    the DELETE touch just the expired rows.
+    """
+    _flush_seen()
+    _flush_lt_hashes()
+    now = int(time.time())
+    if now - _SEEN_SWEEP["ts"] < SEEN_SWEEP_SEC:
+        return
+    _SEEN_SWEEP["ts"] = now
+    with _DB_LOCK, DB:
+        DB.execute("DELETE FROM seen WHERE ts < ?", (now - SEEN_RETENTION_SEC,))
+        DB.execute("DELETE FROM lt_hash WHERE ts < ?", (now - TX_LT_TTL,))
+    # list() snapshots in one step; other threads may be adding entries
+    cutoff = now - SEEN_RETENTION_SEC
+    stale = [k for k, ts in list(_SEEN_RECENT.items()) if ts < cutoff]
+    with _SEEN_LOCK:
+        for k in stale:
+            if _SEEN_RECENT.get(k, now) < cutoff:
+                del _SEEN_RECENT[k]
+    for k in [k for k, v in list(TX_LT_CACHE.items()) if now - v[0] >= TX_LT_TTL]:
+        TX_LT_CACHE.pop(k, None)
+
+def seen_mark(chat_id: int, keys: List[str]) -> None:
+    """Record dedupe keys as seen now (used by warmup so old swaps aren't posted)."""
+    if not keys:
+        return
+    now = int(time.time())
+    chat_key = str(chat_id)
+    rows = [(chat_key, _seen_key(k), now) for k in keys]
+    with _SEEN_LOCK:
+        for c, d, _ in rows:
+            _seen_recent_put(d + c.encode(), now)
+    _SEEN_PENDING.extend(rows)
 
 
 
 
 # -------------------- CACHES --------------------
-TX_LT_CACHE: Dict[str, Tuple[int, str]] = {}  # key=f"{account}:{lt}" -> (ts, hash)
-MARKET_CACHE: Dict[str, Dict[str, Any]] = {}  # key=pool or token -> {ts, price_usd, liq_usd, mc_usd, holders}
+TX_LT_TTL = 86400
+
+def _db_load_lt_hashes() -> Dict[str, Tuple[int, str]]:
+    cutoff = int(time.time()) - TX_LT_TTL
+    return {k: (ts, h) for k, ts, h in DB.execute("SELECT key, ts, hash FROM lt_hash WHERE ts > ?", (cutoff,))}
+
+TX_LT_CACHE: Dict[str, Tuple[int, str]] = _db_load_lt_hashes()  # key=f"{account}:{lt}" -> (ts, hash)
+# lookups found since the last flush; appended from worker threads, written once per poll cycle
+_LT_PENDING: List[Tuple[str, int, str]] = []
+
+def _remember_lt_hash(key: str, ts: int, h: str) -> None:
+    TX_LT_CACHE[key] = (ts, h)
+    _LT_PENDING.append((key, ts, h))
+
+def _flush_lt_hashes() -> None:
+    if not _LT_PENDING:
+        return
+    # swap the list out first so appends racing with the write land in the next batch
+    batch = _LT_PENDING[:]
+    del _LT_PENDING[:len(batch)]
+    with _DB_LOCK, DB:
+        DB.executemany("INSERT OR REPLACE INTO lt_hash (key, ts, hash) VALUES (?, ?, ?)", batch)
+
+# Per-address TTL cache for the token/pool info fetchers; key=f"{kind}:{addr}" -> (ts, value).
+# Failed lookups are stored as _META_MISS for a short while, so a token an upstream
+# doesn't know (or a rate-limited endpoint) isn't re-asked by every group on every tick.
+_TOKEN_META: Dict[str, Tuple[float, Any]] = {}
+_TOKEN_META_MAX = 4096
+_META_MISS = object()
+# metadata is effectively static; entries carrying price/holders expire quickly
+META_TTL = 3600
+DEX_PAIRS_TTL = 60  # raw DexScreener pairs (per token and per pair id), reused across lookups
+PRICE_TTL = 30
+HOLDERS_TTL = 300
+META_MISS_TTL = 60
+
+def _meta_cache_get(kind: str, addr: str, ttl: float) -> Optional[Any]:
+    """Cached value, _META_MISS for a recent failed lookup, or None when the caller should fetch."""
+    hit = _TOKEN_META.get(f"{kind}:{addr}")
+    if hit and time.time() - hit[0] < (min(ttl, META_MISS_TTL) if hit[1] is _META_MISS else ttl):
+        return hit[1]
+    return None
+
+def _meta_cache_put(kind: str, addr: str, value: Any) -> None:
+    key = f"{kind}:{addr}"
+    _TOKEN_META.pop(key, None)
+    if len(_TOKEN_META) >= _TOKEN_META_MAX:
+        # oldest insert first
+        _TOKEN_META.pop(next(iter(_TOKEN_META)), None)
+    _TOKEN_META[key] = (time.time(), value)
 
 # Jetton metadata cache (decimals/symbol/name) to fix wrong amounts from some DEX APIs
 JETTON_META_CACHE: dict[str, dict] = {}  # jetton_addr -> {ts, name, symbol, decimals}
@@ -595,15 +1229,27 @@ def get_jetton_meta(jetton: str, ttl: int = 3600) -> dict:
 TON_PRICE_CACHE: Dict[str, Any] = {"ts": 0, "usd": None}
 
 BOT_USERNAME_CACHE = None
+# deep-link prefixes, filled in once the bot username is known
+DM_CFG_PREFIX = ""
+ADD_TO_GROUP_URL = ""
 
 async def get_bot_username(bot):
-    global BOT_USERNAME_CACHE
+    global BOT_USERNAME_CACHE, DM_CFG_PREFIX, ADD_TO_GROUP_URL
     if BOT_USERNAME_CACHE:
         return BOT_USERNAME_CACHE
     me = await bot.get_me()
     BOT_USERNAME_CACHE = me.username
+    if BOT_USERNAME_CACHE:
+        DM_CFG_PREFIX = f"https://t.me/{BOT_USERNAME_CACHE}?start=cfg_"
+        ADD_TO_GROUP_URL = f"https://t.me/{BOT_USERNAME_CACHE}?startgroup=true"
     return BOT_USERNAME_CACHE
 
+async def dm_cfg_url(bot, chat_id: int) -> str:
+    """Deep link that opens the DM config flow for chat_id."""
+    if not DM_CFG_PREFIX:
+        await get_bot_username(bot)
+    return DM_CFG_PREFIX + str(chat_id)
+
 
 async def stonfi_latest_swaps(pool: str, limit: int = 25) -> List[Dict[str, Any]]:
     """Best-effort: fetch latest pool transactions from TonAPI and treat them as swaps for warmup.
@@ -626,27 +1272,36 @@ async def dedust_latest_trades(pool: str, limit: int = 25) -> List[Dict[str, Any
     except Exception:
         return []
 
+async def _no_items() -> List[Dict[str, Any]]:
+    return []
+
 async def warmup_seen_for_chat(chat_id: int, ston_pool: str|None, dedust_pool: str|None):
     """Mark latest swaps as seen so the bot does not spam old buys right after configuration.
     Also sets baseline last_* ids so we skip anything older than the moment the token was configured."""
     try:
-        bucket = SEEN.setdefault(str(chat_id), {})
+        seen_keys: List[str] = []
         newest_ston = None
         newest_dedust = None
+        newest_dedust_ts = None
+
+        # the three baselines are independent: fetch them side by side
+        swaps, trades, latest_block = await asyncio.gather(
+            stonfi_latest_swaps(ston_pool, limit=40) if ston_pool else _no_items(),
+            dedust_latest_trades(dedust_pool, limit=60) if dedust_pool else _no_items(),
+            _to_thread(ston_latest_block),
+        )
 
         # STON.fi (warmup by pool tx hashes from TonAPI)
         if ston_pool:
-            swaps = await stonfi_latest_swaps(ston_pool, limit=40)
             for s in swaps:
                 txhash = (s.get('tx_hash') or s.get('txHash') or s.get('hash') or '').strip()
                 if txhash:
-                    bucket[f"ston:{ston_pool}:{txhash}"] = int(time.time())
+                    seen_keys.append(f"ston:{ston_pool}:{txhash}")
                     if newest_ston is None:
                         newest_ston = txhash  # first item is newest
 
         # DeDust (warmup by latest trade ids and tx hashes where available)
         if dedust_pool:
-            trades = await dedust_latest_trades(dedust_pool, limit=60)
             # TonAPI events baseline for DeDust pools that don't expose /trades yet (new/legacy pools)
             if not trades:
                 try:
@@ -691,11 +1346,12 @@ async def warmup_seen_for_chat(chat_id: int, ston_pool: str|None, dedust_pool: s
 
                 txhash = (t.get('tx_hash') or t.get('txHash') or t.get('hash') or '').strip()
                 if txhash:
-                    bucket[f"dedust:{dedust_pool}:{txhash}"] = int(time.time())
+                    seen_keys.append(f"dedust:{dedust_pool}:{txhash}")
 
             if max_lt_i is not None:
                 newest_dedust = str(max_lt_i)
-            newest_dedust_ts = max_ts_i
+            if max_ts_i is not None:
+                newest_dedust_ts = max_ts_i
 
         # save baselines into group token so polling skips older history
         g = GROUPS.get(str(chat_id)) or {}
@@ -711,30 +1367,36 @@ async def warmup_seen_for_chat(chat_id: int, ston_pool: str|None, dedust_pool: s
             # baseline: ignore anything before now
             tok["ignore_before_ts"] = int(time.time())
             # baseline for STON export cursor: start from current latest block
-            try:
-                latest = await _to_thread(ston_latest_block)
-                if latest is not None:
-                    tok["ston_last_block"] = int(latest)
-            except Exception:
-                pass
-            save_groups()
+            if latest_block is not None:
+                tok["ston_last_block"] = int(latest_block)
+            mark_groups_dirty()
 
-        save_seen()
+        await _to_thread(seen_mark, chat_id, seen_keys)
     except Exception:
         return
 
+def _seen_recent_put(k: bytes, ts: int) -> None:
+    # caller holds _SEEN_LOCK
+    _SEEN_RECENT.pop(k, None)
+    if len(_SEEN_RECENT) >= _SEEN_RECENT_MAX:
+        _SEEN_RECENT.pop(next(iter(_SEEN_RECENT)), None)
+    _SEEN_RECENT[k] = ts
+
 def dedupe_ok(chat_id: int, key: str, ttl: int = 600) -> bool:
+    """True (and mark it seen) if key wasn't seen for this chat within ttl.
+
+    Runs on the event loop, so it is answered from memory only; the row is queued for
+    save_seen's batched write off the loop.
+    """
     now = int(time.time())
-    bucket = SEEN.setdefault(str(chat_id), {})
-    # clean a little
-    if len(bucket) > 4000:
-        for k, ts in list(bucket.items())[:800]:
-            if now - int(ts) > ttl:
-                bucket.pop(k, None)
-    ts = bucket.get(key)
-    if ts and now - int(ts) < ttl:
-        return False
-    bucket[key] = now
+    chat_key, digest = str(chat_id), _seen_key(key)
+    k = digest + chat_key.encode()
+    with _SEEN_LOCK:
+        ts = _SEEN_RECENT.get(k)
+        if ts is not None and now - ts < ttl:
+            return False
+        _seen_recent_put(k, now)
+    _SEEN_PENDING.append((chat_key, digest, now))
     return True
 
 def anti_spam_limit(level: str) -> Tuple[int,int]:
@@ -747,33 +1409,47 @@ def anti_spam_limit(level: str) -> Tuple[int,int]:
     return (8, BURST_WINDOW_SEC)
 
 # -------------------- TONAPI --------------------
-def tonapi_headers() -> Dict[str, str]:
-    if not TONAPI_KEY:
-        return {"Accept": "application/json"}
-    return {"Authorization": f"Bearer {TONAPI_KEY}", "Accept": "application/json"}
+# cap on TonAPI requests in flight across all groups (keyless access is rate-limited)
+_TONAPI_SLOTS = threading.BoundedSemaphore(max(1, int(os.getenv("TONAPI_CONCURRENCY", "10"))))
+
+# built once (read-only); passed per request rather than set on SESSION so the key only goes to TonAPI
+_TONAPI_HEADERS: Mapping[str, str] = MappingProxyType(
+    {"Authorization": f"Bearer {TONAPI_KEY}", "Accept": "application/json"} if TONAPI_KEY else {"Accept": "application/json"}
+)
+# alternate auth scheme, tried once on 401/403
+_TONAPI_HEADERS_XKEY: Mapping[str, str] = MappingProxyType({"X-API-Key": TONAPI_KEY, "Accept": "application/json"})
+
+def tonapi_headers() -> Mapping[str, str]:
+    return _TONAPI_HEADERS
 
 def tonapi_get_raw(url: str, params: Optional[Dict[str, Any]] = None) -> Optional[Any]:
     """HTTP GET helper for TonAPI with light retry/backoff.
 
     Without a TONAPI key, TonAPI can rate-limit (429). We retry a few times and
     fall back to the last known holders value in the caller if still unavailable.
+    Concurrent calls for the same url+params share one fetch.
     """
+    return _coalesce(_flight_key(url, params), lambda: _tonapi_get_raw(url, params))
+
+def _tonapi_get_raw(url: str, params: Optional[Dict[str, Any]] = None) -> Optional[Any]:
     headers = tonapi_headers()
     # retry on 429 / transient 5xx
     for attempt in range(4):
         try:
-            res = requests.get(url, headers=headers, params=params, timeout=20)
-            # If the user provided a key but used the wrong header scheme, try X-API-Key once.
-            if res.status_code in (401, 403) and TONAPI_KEY:
-                res = requests.get(
-                    url,
-                    headers={"X-API-Key": TONAPI_KEY, "Accept": "application/json"},
-                    params=params,
-                    timeout=20,
-                )
+            with _TONAPI_SLOTS:
+                res = _http_get("tonapi", url, headers=headers, params=params, timeout=20)
+                # If the user provided a key but used the wrong header scheme, try X-API-Key once.
+                if res.status_code in (401, 403) and TONAPI_KEY:
+                    res = _http_get(
+                        "tonapi",
+                        url,
+                        headers=_TONAPI_HEADERS_XKEY,
+                        params=params,
+                        timeout=20,
+                    )
 
             if res.status_code == 200:
-                return res.json()
+                return orjson.loads(res.content)
 
             # rate limit or temporary server issues: backoff and retry
             if res.status_code in (429, 500, 502, 503, 504):
@@ -806,9 +1482,16 @@ def tonapi_jetton_info(jetton: str) -> Dict[str, Any]:
 
     Note: Some DEX endpoints return amounts in minimal units, so decimals are critical.
     """
+    # carries holders_count, so this uses the shorter holders TTL
+    hit = _meta_cache_get("tonapi", jetton, HOLDERS_TTL)
     out: Dict[str, Any] = {"name": "", "symbol": "", "decimals": 9, "holders_count": None}
+    if hit is _META_MISS:
+        return out
+    if hit is not None:
+        return dict(hit)
     js = tonapi_get(f"{TONAPI_BASE}/v2/jettons/{jetton}")
     if not js:
+        _meta_cache_put("tonapi", jetton, _META_MISS)
         return out
 
     meta = js.get("metadata") or {}
@@ -842,7 +1525,8 @@ def tonapi_jetton_info(jetton: str) -> Dict[str, Any]:
     except Exception:
         pass
 
-    return out
+    _meta_cache_put("tonapi", jetton, out)
+    return dict(out)
 
 def tonapi_jetton_holders_count(jetton: str) -> Optional[int]:
     """Best-effort holders count. Some TonAPI responses don't include holders_count on the main jetton endpoint."""
@@ -870,19 +1554,44 @@ def tonapi_jetton_holders_count(jetton: str) -> Optional[int]:
         return None
 
 
-def tonapi_account_transactions(address: str, limit: int = 12) -> List[Dict[str, Any]]:
+# (kind, address, limit) -> (ts, items). TonAPI has no bulk endpoint for transactions/events,
+# so groups sharing a pool share one fetch per poll tick instead.
+_ACCOUNT_FEED_CACHE: Dict[Tuple[str, str, int], Tuple[float, List[Dict[str, Any]]]] = {}
+_ACCOUNT_FEED_MAX = 1024
+
+def _account_feed(kind: str, address: str, limit: int, fetch) -> List[Dict[str, Any]]:
+    key = (kind, address, int(limit))
+    hit = _ACCOUNT_FEED_CACHE.get(key)
+    now = time.time()
+    if hit and now - hit[0] < POLL_INTERVAL:
+        return hit[1]
+    items = fetch()
+    if items:
+        _ACCOUNT_FEED_CACHE.pop(key, None)
+        if len(_ACCOUNT_FEED_CACHE) >= _ACCOUNT_FEED_MAX:
+            # oldest insert first; pools nobody polls anymore age out here
+            _ACCOUNT_FEED_CACHE.pop(next(iter(_ACCOUNT_FEED_CACHE)), None)
+        _ACCOUNT_FEED_CACHE[key] = (now, items)
+    return items
+
+def _tonapi_account_transactions(address: str, limit: int) -> List[Dict[str, Any]]:
     js = tonapi_get(f"{TONAPI_BASE}/v2/blockchain/accounts/{address}/transactions", params={"limit": limit})
     txs = js.get("transactions") if isinstance(js, dict) else None
     return txs if isinstance(txs, list) else []
 
-def tonapi_account_events(address: str, limit: int = 10) -> List[Dict[str, Any]]:
+def tonapi_account_transactions(address: str, limit: int = 12) -> List[Dict[str, Any]]:
+    return _account_feed("tx", address, limit, lambda: _tonapi_account_transactions(address, limit))
+
+def _tonapi_account_events(address: str, limit: int) -> List[Dict[str, Any]]:
     js = tonapi_get(f"{TONAPI_BASE}/v2/accounts/{address}/events", params={"limit": limit})
     ev = js.get("events") if isinstance(js, dict) else None
     return ev if isinstance(ev, list) else []
 
+def tonapi_account_events(address: str, limit: int = 10) -> List[Dict[str, Any]]:
+    return _account_feed("events", address, limit, lambda: _tonapi_account_events(address, limit))
 
-def tonapi_account_events_subject(address: str, limit: int = 30) -> List[Dict[str, Any]]:
-    """TonAPI account events with subject_only=true (less noise, better for DEX pool monitoring)."""
+
+def _tonapi_account_events_subject(address: str, limit: int) -> List[Dict[str, Any]]:
     js = tonapi_get(
         f"{TONAPI_BASE}/v2/accounts/{address}/events",
         params={"limit": limit, "subject_only": "true"},
@@ -890,6 +1599,10 @@ def tonapi_account_events_subject(address: str, limit: int = 30) -> List[Dict[st
     ev = js.get("events") if isinstance(js, dict) else None
     return ev if isinstance(ev, list) else []
 
+def tonapi_account_events_subject(address: str, limit: int = 30) -> List[Dict[str, Any]]:
+    """TonAPI account events with subject_only=true (less noise, better for DEX pool monitoring)."""
+    return _account_feed("events_subject", address, limit, lambda: _tonapi_account_events_subject(address, limit))
+
 def tonapi_event_tx_hash(ev: Dict[str, Any]) -> str:
     """Best-effort extraction of a real tx hash from a TonAPI event."""
     if not isinstance(ev, dict):
@@ -920,6 +1633,26 @@ def tonapi_event_tx_hash(ev: Dict[str, Any]) -> str:
                 return h2
     return ""
 
+def _tx_lt_and_hash(tx: Any) -> Tuple[str, str]:
+    if not isinstance(tx, dict):
+        return "", ""
+    tid = tx.get("transaction_id") or {}
+    tx_lt = str(tid.get("lt") or tx.get("lt") or "").strip()
+    h = tid.get("hash") or tx.get("hash") or tx.get("tx_hash") or tx.get("id")
+    return tx_lt, str(h or "").strip()
+
+def _tonapi_tx_hash_at_lt(account: str, lt_s: str) -> str:
+    js = tonapi_get(
+        f"{TONAPI_BASE}/v2/blockchain/accounts/{account}/transactions",
+        params={"before_lt": int(lt_s) + 1, "limit": 1},
+    )
+    txs = js.get("transactions") if isinstance(js, dict) else None
+    for tx in txs if isinstance(txs, list) else []:
+        tx_lt, h = _tx_lt_and_hash(tx)
+        if tx_lt == lt_s and h:
+            return h
+    return ""
+
 def tonapi_find_tx_hash_by_lt(account: str, lt: str, limit: int = 40) -> str:
     """Find a real transaction hash for an account by LT (with cache + adaptive scan).
 
@@ -936,12 +1669,18 @@ def tonapi_find_tx_hash_by_lt(account: str, lt: str, limit: int = 40) -> str:
 
     cache_key = f"{account}:{lt_s}"
     now = int(time.time())
-    # 24h cache
+    # 24h cache (persisted in lt_hash)
     cached = TX_LT_CACHE.get(cache_key)
-    if cached and now - int(cached[0]) < 86400:
+    if cached and now - int(cached[0]) < TX_LT_TTL:
         return str(cached[1] or "").strip()
 
-    # Adaptive scan sizes (fast -> deeper)
+    # Direct probe: the newest tx strictly below lt+1 is the one we want (one request).
+    h = _tonapi_tx_hash_at_lt(account, lt_s)
+    if h:
+        _remember_lt_hash(cache_key, now, h)
+        return h
+
+    # Adaptive scan sizes (fast -> deeper), for when the probe comes back empty
     scan_limits = [max(40, int(limit or 40)), 120, 300, 600]
     for lim in scan_limits:
         try:
@@ -961,14 +1700,10 @@ def tonapi_find_tx_hash_by_lt(account: str, lt: str, limit: int = 40) -> str:
                 h = tid.get("hash") or tx.get("hash") or tx.get("tx_hash") or tx.get("id")
                 h = str(h or "").strip()
                 if h:
-                    TX_LT_CACHE[cache_key] = (now, h)
+                    _remember_lt_hash(cache_key, now, h)
                     return h
         except Exception:
-            # brief retry on transient errors
-            try:
-                time.sleep(0.35)
-            except Exception:
-                pass
+            # transient HTTP errors are already retried with backoff by tonapi_get (_tonapi_get_raw)
             continue
 
     return ""
@@ -983,14 +1718,14 @@ def ton_usd_price() -> Optional[float]:
         pass
     # Best-effort CoinGecko simple price
     try:
-        r = requests.get(
+        r = _http_get(
+            "coingecko",
             "https://api.coingecko.com/api/v3/simple/price",
             params={"ids": "the-open-network", "vs_currencies": "usd"},
             timeout=10,
-            headers={"accept": "application/json", "user-agent": "SpyTONBuyBot/1.0"},
         )
         if r.status_code == 200:
-            js = r.json()
+            js = orjson.loads(r.content)
             usd = js.get("the-open-network", {}).get("usd")
             if usd is not None:
                 TON_PRICE_CACHE["usd"] = float(usd)
@@ -1027,113 +1762,152 @@ def gecko_get(path: str, params: Optional[dict] = None) -> Optional[dict]:
     """GeckoTerminal public API (best-effort)."""
     try:
         url = f"{GECKO_BASE}{path}"
-        r = requests.get(
-            url,
-            params=params or {},
-            headers={
-                "accept": "application/json",
-                "user-agent": "SpyTONBuyBot/1.0",
-            },
-            timeout=12,
-        )
+        r = _shared_get("gecko", url, params=params, timeout=12)
         if r.status_code != 200:
             return None
-        return r.json()
+        return orjson.loads(r.content)
     except Exception:
         return None
 
 def gecko_token_info(token_addr: str) -> Optional[dict]:
     # token_addr should be a jetton master (EQ.. / UQ..)
+    # includes price/mcap, so only the short price TTL applies
+    hit = _meta_cache_get("gecko_token", token_addr, PRICE_TTL)
+    if hit is _META_MISS:
+        return None
+    if hit is not None:
+        return dict(hit)
     j = gecko_get(f"/networks/ton/tokens/{token_addr}")
     if not j or "data" not in j:
+        _meta_cache_put("gecko_token", token_addr, _META_MISS)
         return None
     attrs = (j.get("data") or {}).get("attributes") or {}
-    return {
+    info = {
         "name": attrs.get("name") or "",
         "symbol": attrs.get("symbol") or "",
         "decimals": attrs.get("decimals"),
         "price_usd": attrs.get("price_usd"),
         "market_cap_usd": attrs.get("market_cap_usd") or attrs.get("fdv_usd"),
     }
+    _meta_cache_put("gecko_token", token_addr, info)
+    return dict(info)
 
 def gecko_pool_info(pool_addr: str) -> Optional[dict]:
+    hit = _meta_cache_get("gecko_pool", pool_addr, PRICE_TTL)
+    if hit is _META_MISS:
+        return None
+    if hit is not None:
+        return dict(hit)
     j = gecko_get(f"/networks/ton/pools/{pool_addr}")
     if not j or "data" not in j:
+        _meta_cache_put("gecko_pool", pool_addr, _META_MISS)
         return None
     attrs = (j.get("data") or {}).get("attributes") or {}
-    return {
+    info = {
         "price_usd": attrs.get("base_token_price_usd") or attrs.get("price_usd"),
         "liquidity_usd": attrs.get("reserve_in_usd") or attrs.get("liquidity_usd"),
         "fdv_usd": attrs.get("fdv_usd"),
         "market_cap_usd": attrs.get("market_cap_usd") or attrs.get("fdv_usd"),
         "name": attrs.get("name"),
     }
+    _meta_cache_put("gecko_pool", pool_addr, info)
+    return dict(info)
+
+GECKO_POOL_URL_PREFIX = "https://www.geckoterminal.com/ton/pools/"
 
 def gecko_terminal_pool_url(pool_addr: str) -> str:
-    return f"https://www.geckoterminal.com/ton/pools/{pool_addr}"
+    return GECKO_POOL_URL_PREFIX + pool_addr
 
-def find_pair_for_token_on_dex(token_address: str, want_dex: str) -> Optional[str]:
-    url = f"{DEX_TOKEN_URL}/{token_address}"
+def _dex_token_pairs(token_address: str) -> Optional[List[Dict[str, Any]]]:
+    """DexScreener `pairs` list for a token (briefly cached; shared by pair discovery and metadata)."""
+    hit = _meta_cache_get("dex_pairs", token_address, DEX_PAIRS_TTL)
+    if hit is not None:
+        return hit
     try:
-        res = requests.get(url, timeout=20)
+        res = _shared_get("dexscreener", f"{DEX_TOKEN_URL}/{token_address}", timeout=20)
         if res.status_code != 200:
             return None
-        js = res.json()
-        pairs = js.get("pairs") if isinstance(js, dict) else None
-        if not isinstance(pairs, list):
-            return None
-
-        want = want_dex.lower()
-        best_pair_id = None
-        best_score = -1.0
+        js = orjson.loads(res.content)
+    except Exception:
+        return None
+    pairs = js.get("pairs") if isinstance(js, dict) else None
+    if not isinstance(pairs, list):
+        return None
+    _meta_cache_put("dex_pairs", token_address, pairs)
+    return pairs
 
-        for p in pairs:
-            if not isinstance(p, dict):
-                continue
-            dex_id = (p.get("dexId") or "").lower()
-            chain_id = (p.get("chainId") or "").lower()
-            if chain_id != "ton":
-                continue
+def _is_ton_pair(p: Any) -> bool:
+    if not isinstance(p, dict) or (p.get("chainId") or "").lower() != "ton":
+        return False
+    base_sym = ((p.get("baseToken") or {}).get("symbol") or "").upper()
+    quote_sym = ((p.get("quoteToken") or {}).get("symbol") or "").upper()
+    return base_sym in _TON_SYMBOLS or quote_sym in _TON_SYMBOLS
 
-            if want == "stonfi" and "ston" not in dex_id:
-                continue
-            if want == "dedust" and "dedust" not in dex_id:
-                continue
+def _pair_score(p: Dict[str, Any]) -> float:
+    # liquidity first, 24h volume as tie-break
+    try:
+        liq = float(((p.get("liquidity") or {}).get("usd") or 0) or 0)
+    except Exception:
+        liq = 0.0
+    try:
+        vol = float(((p.get("volume") or {}).get("h24") or 0) or 0)
+    except Exception:
+        vol = 0.0
+    return liq * 1_000_000 + vol
 
-            base = p.get("baseToken") or {}
-            quote = p.get("quoteToken") or {}
-            base_sym = (base.get("symbol") or "").upper()
-            quote_sym = (quote.get("symbol") or "").upper()
-            if base_sym not in ("TON","WTON") and quote_sym not in ("TON","WTON"):
-                continue
+def _pair_id(p: Dict[str, Any]) -> str:
+    pair_id = (p.get("pairAddress") or p.get("pairId") or p.get("pair") or "").strip()
+    if not pair_id:
+        u = (p.get("url") or "")
+        if "/ton/" in u:
+            pair_id = u.split("/ton/")[-1].split("?")[0].strip()
+    return pair_id
 
-            pair_id = (p.get("pairAddress") or p.get("pairId") or p.get("pair") or "").strip()
-            if not pair_id:
-                u = (p.get("url") or "")
-                if "/ton/" in u:
-                    pair_id = u.split("/ton/")[-1].split("?")[0].strip()
-            if not pair_id:
-                continue
+def _dex_pair_summary(token_address: str) -> Optional[Dict[str, Any]]:
+    """One pass over a token's DexScreener pairs, shared by pair discovery and metadata.
 
-            liq = 0.0
-            vol = 0.0
-            try:
-                liq = float(((p.get("liquidity") or {}).get("usd") or 0) or 0)
-            except Exception:
-                liq = 0.0
-            try:
-                vol = float(((p.get("volume") or {}).get("h24") or 0) or 0)
-            except Exception:
-                vol = 0.0
+    Returns {"stonfi"/"dedust"/"any": best addressable TON pair id or None,
+    "top": best TON pair dict (else the first pair) or None}, picking by liquidity,
+    then 24h volume. None when DexScreener didn't answer.
+    """
+    hit = _meta_cache_get("dex_best", token_address, DEX_PAIRS_TTL)
+    if hit is not None:
+        return hit
+    pairs = _dex_token_pairs(token_address)
+    if pairs is None:
+        return None
+    best: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+    for p in pairs:
+        if not _is_ton_pair(p):
+            continue
+        score = _pair_score(p)
+        slots = ["top"]
+        # only pairs we can address are pool candidates
+        if _pair_id(p):
+            dex = (p.get("dexId") or "").lower()
+            slots.append("any")
+            if "ston" in dex:
+                slots.append("stonfi")
+            if "dedust" in dex:
+                slots.append("dedust")
+        for k in slots:
+            cur = best.get(k)
+            if cur is None or score > cur[0]:
+                best[k] = (score, p)
+    out: Dict[str, Any] = {k: (_pair_id(best[k][1]) if k in best else None) for k in ("stonfi", "dedust", "any")}
+    first = pairs[0] if pairs and isinstance(pairs[0], dict) else None
+    out["top"] = best["top"][1] if "top" in best else first
+    _meta_cache_put("dex_best", token_address, out)
+    return out
 
-            score = liq * 1_000_000 + vol
-            if score > best_score:
-                best_score = score
-                best_pair_id = pair_id
+def find_ton_pairs_for_token(token_address: str) -> Dict[str, Optional[str]]:
+    """Best TON pair per DEX for a token: {"stonfi": pair_id|None, "dedust": ..., "any": ...}."""
+    summary = _dex_pair_summary(token_address) or {}
+    return {k: summary.get(k) for k in ("stonfi", "dedust", "any")}
 
-        return best_pair_id
-    except Exception:
-        return None
+def find_pair_for_token_on_dex(token_address: str, want_dex: str) -> Optional[str]:
+    want = want_dex.lower()
+    return find_ton_pairs_for_token(token_address).get(want if want in ("stonfi", "dedust") else "any")
 
 def find_stonfi_ton_pair_for_token(token_address: str) -> Optional[str]:
     return find_pair_for_token_on_dex(token_address, "stonfi")
@@ -1145,65 +1919,39 @@ def dex_token_info(token_address: str) -> Dict[str, str]:
     DexScreener often has token name/symbol even when TonAPI metadata is missing.
     We pick the TON pair with best liquidity/volume and read the non-TON side.
     """
+    hit = _meta_cache_get("dex_token", token_address, META_TTL)
     out = {"name": "", "symbol": ""}
+    if hit is _META_MISS:
+        return out
+    if hit is not None:
+        return dict(hit)
     try:
         g = gecko_token_info(token_address)
         if g:
             out["name"] = g.get("name") or out["name"]
             out["symbol"] = g.get("symbol") or out["symbol"]
             if out["name"] or out["symbol"]:
-                return out
-        res = requests.get(f"{DEX_TOKEN_URL}/{token_address}", timeout=20)
-        if res.status_code != 200:
-            return out
-        js = res.json()
-        pairs = js.get("pairs") if isinstance(js, dict) else None
-        if not isinstance(pairs, list) or not pairs:
-            return out
-
-        best = None
-        best_score = -1.0
-        for p in pairs:
-            if not isinstance(p, dict):
-                continue
-            if (p.get("chainId") or "").lower() != "ton":
-                continue
-            base = p.get("baseToken") or {}
-            quote = p.get("quoteToken") or {}
-            base_sym = (base.get("symbol") or "").upper()
-            quote_sym = (quote.get("symbol") or "").upper()
-            if base_sym not in ("TON","WTON") and quote_sym not in ("TON","WTON"):
-                continue
-            liq = 0.0
-            vol = 0.0
-            try:
-                liq = float(((p.get("liquidity") or {}).get("usd") or 0) or 0)
-            except Exception:
-                liq = 0.0
-            try:
-                vol = float(((p.get("volume") or {}).get("h24") or 0) or 0)
-            except Exception:
-                vol = 0.0
-            score = liq * 1_000_000 + vol
-            if score > best_score:
-                best_score = score
-                best = p
-
+                _meta_cache_put("dex_token", token_address, out)
+                return dict(out)
+        best = (_dex_pair_summary(token_address) or {}).get("top")
         if not best:
-            best = pairs[0]
+            _meta_cache_put("dex_token", token_address, _META_MISS)
+            return out
 
         base = best.get("baseToken") or {}
         quote = best.get("quoteToken") or {}
         base_addr = str(base.get("address") or "")
         quote_addr = str(quote.get("address") or "")
         # Choose the side that matches the token_address if possible
-        tok = base if base_addr == token_address else (quote if quote_addr == token_address else None)
+        canon = _canon_addr(token_address)
+        tok = base if _same_addr(base_addr, canon) else (quote if _same_addr(quote_addr, canon) else None)
         if not tok:
             # Otherwise choose non-TON side
             tok = quote if (str(base.get("symbol") or "").upper() in ("TON","WTON")) else base
         out["name"] = str(tok.get("name") or "").strip()
         out["symbol"] = str(tok.get("symbol") or "").strip()
-        return out
+        _meta_cache_put("dex_token", token_address, out if out["name"] or out["symbol"] else _META_MISS)
+        return dict(out)
     except Exception:
         return out
 
@@ -1230,6 +1978,8 @@ def _tx_hash(tx: Dict[str, Any]) -> str:
             return h3.strip()
     return ""
 
+_HEX64_RE = re.compile(r"[0-9a-fA-F]{64}")
+
 def _normalize_tx_hash_to_hex(h: Any) -> str:
     """Return a 64-char lowercase hex tx hash when possible.
 
@@ -1242,28 +1992,31 @@ def _normalize_tx_hash_to_hex(h: Any) -> str:
     if not s:
         return ""
 
+    # Already hex? (the common case: TonAPI hashes) - validated and lowercased in C
+    if len(s) == 64:
+        try:
+            out = bytes.fromhex(s).hex()
+            if len(out) == 64:  # fromhex skips embedded spaces
+                return out
+        except ValueError:
+            pass
     # If a full URL was provided, try to extract a 64-hex hash from it.
     # Examples:
     #   https://tonviewer.com/transaction/<64hex>
     #   https://tonviewer.com/transaction/<64hex>?...
     #   https://tonviewer.com/tx/<64hex>
-    try:
-        m = re.search(r"([0-9a-fA-F]{64})", s)
+    if len(s) > 64:
+        m = _HEX64_RE.search(s)
         if m:
-            return m.group(1).lower()
-    except Exception:
-        pass
-    # Already hex?
-    if re.fullmatch(r"[0-9a-fA-F]{64}", s):
-        return s.lower()
-    # If looks like base64url, try decode -> 32 bytes
-    try:
-        pad = "=" * ((4 - (len(s) % 4)) % 4)
-        b = base64.urlsafe_b64decode(s + pad)
-        if isinstance(b, (bytes, bytearray)) and len(b) == 32:
-            return bytes(b).hex()
-    except Exception:
-        pass
+            return m.group(0).lower()
+    # base64/base64url of 32 bytes is 43 chars (44 padded)
+    if len(s) in (43, 44):
+        try:
+            b = base64.urlsafe_b64decode(s.rstrip("=") + "=")
+            if len(b) == 32:
+                return b.hex()
+        except ValueError:
+            pass
     return ""
 
 def _action_type(a: Dict[str, Any]) -> str:
@@ -1276,18 +2029,39 @@ def _short_addr(a: str) -> str:
         return a
     return a[:4] + "…" + a[-4:]
 
+# legacy Markdown can't escape inside an entity, so token names/symbols (user and API
+# supplied) get its markup characters dropped instead of breaking the message's parse
+_MD_STRIP = str.maketrans("", "", "*_`[")
+
+def _md(s: Any) -> str:
+    return str(s).translate(_MD_STRIP)
+
 def _to_float(x) -> float:
+    # amounts are usually already numbers (or strings); skip float()'s dispatch for the former
+    t = type(x)
+    if t is float:
+        return x
+    if t is int:
+        return float(x)
     try:
         return float(x)
     except Exception:
         return 0.0
 
-def stonfi_extract_buys_from_tonapi_tx(tx: Dict[str, Any], token_addr: str) -> List[Dict[str, Any]]:
+# TonAPI swap action field aliases, in order of preference
+TONAPI_AMOUNT_IN_FIELDS = ("amount_in", "amountIn")
+TONAPI_AMOUNT_OUT_FIELDS = ("amount_out", "amountOut")
+TONAPI_ASSET_IN_FIELDS = ("asset_in", "assetIn", "in")
+TONAPI_ASSET_OUT_FIELDS = ("asset_out", "assetOut", "out")
+TONAPI_BUYER_FIELDS = ("user", "sender", "initiator", "from")
+
+def stonfi_extract_buys_from_tonapi_tx(tx: Dict[str, Any], token_addr: str) -> List[Trade]:
     """Heuristic buy parser from TonAPI tx actions.
     BUY = TON -> token_addr.
     """
-    out: List[Dict[str, Any]] = []
+    out: List[Trade] = []
     tx_hash = _tx_hash(tx)
+    token_addr = _canon_addr(token_addr)
 
     actions = tx.get("actions")
     if not isinstance(actions, list):
@@ -1296,7 +2070,13 @@ def stonfi_extract_buys_from_tonapi_tx(tx: Dict[str, Any], token_addr: str) -> L
     for a in actions:
         if not isinstance(a, dict):
             continue
-        payload = a.get(a.get('type') or a.get('action') or a.get('name'))
+        kind = _action_type(a)
+        payload = a.get(kind)
+        # most actions are plain transfers: reject on the type names before copying anything
+        pre = kind if not isinstance(payload, dict) else kind + " " + _action_type(payload)
+        pre = pre.lower()
+        if "swap" not in pre and "dex" not in pre:
+            continue
         aa = dict(a)
         if isinstance(payload, dict):
             aa.update(payload)
@@ -1313,11 +2093,11 @@ def stonfi_extract_buys_from_tonapi_tx(tx: Dict[str, Any], token_addr: str) -> L
             continue
 
         # Try common fields TonAPI uses
-        ton_in = _to_float(aa.get("amount_in") or aa.get("amountIn") or 0)
-        jet_out = _to_float(aa.get("amount_out") or aa.get("amountOut") or 0)
+        ton_in = _to_float(_first_learned(aa, TONAPI_AMOUNT_IN_FIELDS) or 0)
+        jet_out = _to_float(_first_learned(aa, TONAPI_AMOUNT_OUT_FIELDS) or 0)
 
-        in_asset = aa.get("asset_in") or aa.get("assetIn") or aa.get("in") or {}
-        out_asset = aa.get("asset_out") or aa.get("assetOut") or aa.get("out") or {}
+        in_asset = _first_learned(aa, TONAPI_ASSET_IN_FIELDS) or {}
+        out_asset = _first_learned(aa, TONAPI_ASSET_OUT_FIELDS) or {}
 
         def asset_addr(x):
             if isinstance(x, dict):
@@ -1331,34 +2111,31 @@ def stonfi_extract_buys_from_tonapi_tx(tx: Dict[str, Any], token_addr: str) -> L
         # determine if TON in and token out
         is_buy = False
         # TonAPI might represent TON as "TON" or empty addr
-        if out_addr == token_addr and (in_addr == "" or "ton" in str(in_asset).lower()):
+        is_token_out = _same_addr(out_addr, token_addr)
+        if is_token_out and (in_addr == "" or "ton" in str(in_asset).lower()):
             is_buy = True
         # sometimes out asset is jetton dict nested
         if not is_buy:
             # look inside swap details if present
-            if str(out_addr) == token_addr and ton_in > 0:
+            if is_token_out and ton_in > 0:
                 is_buy = True
 
         if not is_buy:
             continue
 
-        buyer = (aa.get("user") or aa.get("sender") or aa.get("initiator") or aa.get("from") or "")
+        buyer = _first(aa, TONAPI_BUYER_FIELDS) or ""
         if isinstance(buyer, dict):
             buyer = buyer.get("address") or ""
         buyer = str(buyer)
 
-        out.append({
-            "tx": tx_hash,
-            "buyer": buyer,
-            "ton": ton_in if ton_in else None,
-            "token_amount": jet_out if jet_out else None,
-        })
+        out.append(Trade(tx=tx_hash, buyer=buyer, ton=ton_in if ton_in else None, token_amount=jet_out if jet_out else None))
 
     return out
 
 def dedust_extract_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str) -> List[Dict[str, Any]]:
     """TonAPI events endpoint sometimes provides swap action info too."""
     out: List[Dict[str, Any]] = []
+    token_addr = _canon_addr(token_addr)
     # Prefer real transaction hash when present (hex or base64url). Fall back to event id.
     tx_hash = str(ev.get("hash") or ev.get("tx_hash") or ev.get("transaction_hash") or ev.get("id") or ev.get("event_id") or "")
     actions = ev.get("actions")
@@ -1384,7 +2161,7 @@ def dedust_extract_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str) -
         out_addr = ""
         if isinstance(out_asset, dict):
             out_addr = str(out_asset.get("address") or out_asset.get("master") or "")
-        if out_addr and out_addr != token_addr:
+        if out_addr and not _same_addr(out_addr, token_addr):
             continue
 
         buyer = (a.get("user") or a.get("sender") or a.get("initiator") or a.get("from") or "")
@@ -1400,11 +2177,11 @@ def dedust_extract_buys_from_tonapi_event(ev: Dict[str, Any], token_addr: str) -
 
 # -------------------- UI --------------------
 async def build_add_to_group_url(app: Application) -> str:
-    # We try to discover bot username at runtime.
+    # We try to discover bot username at runtime (once; get_bot_username caches it).
     try:
-        me = await app.bot.get_me()
-        if me and me.username:
-            return f"https://t.me/{me.username}?startgroup=true"
+        await get_bot_username(app.bot)
+        if ADD_TO_GROUP_URL:
+            return ADD_TO_GROUP_URL
     except Exception:
         pass
     return "https://t.me/"  # fallback
@@ -1425,7 +2202,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     group_id = None
                 if group_id:
                     # Auto-detect mode: user sends CA, we resolve STON.fi + DeDust pools automatically.
-                    AWAITING[update.effective_user.id] = {"group_id": group_id, "stage": "CA", "dex": "both"}
+                    AWAITING[update.effective_user.id] = AwaitToken(group_id, "CA", "both")
                     await update.message.reply_text(
                         "✅ *SpyTON BuyBot connected*\n\n"
                         "Now send the token CA here in DM.\n"
@@ -1463,230 +2240,268 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
 
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    chat = q.message.chat if q.message else update.effective_chat
-    user = update.effective_user
-    if not chat or not user:
-        return
+# on_button dispatch: exact callback_data first, then its "XXX_" prefix. Every handler
+# takes (update, context, chat, user, data); admin-only ones are wrapped in _admin_only.
 
-    data = q.data or ""
-    if data in ("CFG_PRIVATE","SET_PRIVATE"):
-        # In private we configure a target group via last used group in AWAITING or ask user to do it in group
-        await q.edit_message_text(
-            "To configure a group:\n"
-            "1) Add the bot to your group.\n"
-            "2) In that group, tap *Configure Token*.",
-            parse_mode="Markdown"
-        )
-        return
-
-    if data == "CFG_GROUP":
-        # Crypton-style: group button opens DM config (deep-link) so you don't have to reply in group.
+def _admin_only(fn):
+    async def gated(update, context, chat, user, data):
+        q = update.callback_query
         if not await is_admin(context.bot, chat.id, user.id):
             await q.answer("Admins only.", show_alert=True)
             return
-        bot_username = await get_bot_username(context.bot)
-        deep = f"https://t.me/{bot_username}?start=cfg_{chat.id}"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("Click Here!", url=deep)]])
-        await q.message.reply_text(
-            "To continue, click *Click Here!* and send your token CA in DM.",
-            parse_mode="Markdown",
-            reply_markup=kb,
-        )
-        await q.answer()
-        return
-
-
-    # DEX selection in private DM config
-    if data.startswith("DEX_STON_") or data.startswith("DEX_DEDUST_"):
-        try:
-            group_id = int(data.split("_", 2)[2])
-        except Exception:
-            group_id = None
-        if not group_id:
-            return
-        dex = "ston" if data.startswith("DEX_STON_") else "dedust"
-        AWAITING[user.id] = {"group_id": group_id, "stage": "CA", "dex": dex}
-        await q.edit_message_text(
-            "Send the token CA now (EQ… / UQ…) or a supported link (GT/DexS/STON/DeDust).\n\n"
-            "Optional: add the token Telegram link after the CA.\n"
-            "Example: EQ... https://t.me/YourTokenTG"
-        )
-        return
+        await fn(update, context, chat, user, data)
+    return gated
 
-    if data == "TOKENSET_GROUP":
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        await send_token_settings(chat.id, context, q.message)
-        return
+async def _btn_private_help(update, context, chat, user, data):
+    # In private we configure a target group via last used group in AWAITING or ask user to do it in group
+    q = update.callback_query
+    await q.edit_message_text(
+        "To configure a group:\n"
+        "1) Add the bot to your group.\n"
+        "2) In that group, tap *Configure Token*.",
+        parse_mode="Markdown"
+    )
 
-    if data.startswith("TS_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        await handle_token_settings_button(chat.id, data, update, context)
-        return
+@_admin_only
+async def _btn_cfg_group(update, context, chat, user, data):
+    # Crypton-style: group button opens DM config (deep-link) so you don't have to reply in group.
+    q = update.callback_query
+    deep = await dm_cfg_url(context.bot, chat.id)
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("Click Here!", url=deep)]])
+    await q.message.reply_text(
+        "To continue, click *Click Here!* and send your token CA in DM.",
+        parse_mode="Markdown",
+        reply_markup=kb,
+    )
+    await q.answer()
 
-    if data == "SET_GROUP":
-        # Settings should open the Crypton-style module menu (Token Settings),
-        # not the legacy quick-toggles panel.
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        await send_token_settings(chat.id, context, q.message)
+async def _btn_dex_select(update, context, chat, user, data):
+    # DEX selection in private DM config: DEX_STON_<group> / DEX_DEDUST_<group>
+    q = update.callback_query
+    if data.startswith("DEX_STON_"):
+        dex = "ston"
+    elif data.startswith("DEX_DEDUST_"):
+        dex = "dedust"
+    else:
+        return  # stale or malformed callback
+    try:
+        group_id = int(data.split("_", 2)[2])
+    except Exception:
+        group_id = None
+    if not group_id:
         return
+    AWAITING[user.id] = AwaitToken(group_id, "CA", dex)
+    await q.edit_message_text(
+        "Send the token CA now (EQ… / UQ…) or a supported link (GT/DexS/STON/DeDust).\n\n"
+        "Optional: add the token Telegram link after the CA.\n"
+        "Example: EQ... https://t.me/YourTokenTG"
+    )
 
-    if data.startswith("TOG_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        if data == "TOG_STON":
-            s["enable_ston"] = not bool(s.get("enable_ston", True))
-        elif data == "TOG_DEDUST":
-            prev = bool(s.get("enable_dedust", True))
-            s["enable_dedust"] = not prev
-            # If turning ON, baseline DeDust so it never dumps old buys.
-            if (not prev) and bool(s["enable_dedust"]):
-                tok = g.get("token") if isinstance(g, dict) else None
-                if isinstance(tok, dict) and tok.get("dedust_pool"):
-                    try:
-                        await warmup_seen_for_chat(chat.id, None, tok.get("dedust_pool"))
-                    except Exception:
-                        pass
-                    tok["init_done"] = False
-                    save_groups()
-        elif data == "TOG_BURST":
-            s["burst_mode"] = not bool(s.get("burst_mode", True))
-        elif data == "TOG_STRENGTH":
-            s["strength_on"] = not bool(s.get("strength_on", True))
-        elif data == "TOG_IMAGE":
-            s["buy_image_on"] = not bool(s.get("buy_image_on", False))
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+@_admin_only
+async def _btn_token_settings(update, context, chat, user, data):
+    # SET_GROUP opens the Crypton-style module menu (Token Settings) too,
+    # not the legacy quick-toggles panel.
+    q = update.callback_query
+    await send_token_settings(chat.id, context, q.message)
+
+@_admin_only
+async def _btn_token_settings_action(update, context, chat, user, data):
+    await handle_token_settings_button(chat.id, data, update, context)
+
+# callback -> (settings key, default when unset)
+_TOGGLES = {
+    "TOG_STON": ("enable_ston", True),
+    "TOG_DEDUST": ("enable_dedust", True),
+    "TOG_BURST": ("burst_mode", True),
+    "TOG_STRENGTH": ("strength_on", True),
+    "TOG_IMAGE": ("buy_image_on", False),
+}
 
-    if data == "IMG_SET":
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        # Next photo from this admin will be saved as the buy image for this group.
-        AWAITING_IMAGE[user.id] = chat.id
-        await q.message.reply_text("Send the *buy image* now as a Telegram photo (not a file).", parse_mode="Markdown")
-        return
+@_admin_only
+async def _btn_toggle(update, context, chat, user, data):
+    q = update.callback_query
+    g = get_group(chat.id)
+    s = g["settings"]
+    t = _TOGGLES.get(data)
+    if t is not None:
+        key, default = t
+        s[key] = on = not bool(s.get(key, default))
+        # If turning DeDust ON, baseline it so it never dumps old buys.
+        if on and key == "enable_dedust":
+            tok = g.get("token") if isinstance(g, dict) else None
+            if isinstance(tok, dict) and tok.get("dedust_pool"):
+                try:
+                    await warmup_seen_for_chat(chat.id, None, tok.get("dedust_pool"))
+                except Exception:
+                    pass
+                tok["init_done"] = False
+    mark_groups_dirty()
+    await send_settings(chat.id, context, q.message, edit=True)
 
-    if data == "IMG_CLEAR":
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        g["settings"]["buy_image_file_id"] = ""
-        g["settings"]["buy_image_on"] = False
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+@_admin_only
+async def _btn_img_set(update, context, chat, user, data):
+    # Next photo from this admin will be saved as the buy image for this group.
+    q = update.callback_query
+    AWAITING_IMAGE[user.id] = chat.id
+    await q.message.reply_text("Send the *buy image* now as a Telegram photo (not a file).", parse_mode="Markdown")
 
-    if data.startswith("MIN_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        val = float(data.split("_",1)[1])
-        s["min_buy_ton"] = val
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+@_admin_only
+async def _btn_img_clear(update, context, chat, user, data):
+    q = update.callback_query
+    g = get_group(chat.id)
+    g["settings"]["buy_image_file_id"] = ""
+    g["settings"]["buy_image_on"] = False
+    mark_groups_dirty()
+    await send_settings(chat.id, context, q.message, edit=True)
+
+# settings-panel value buttons, parsed once: callback -> (settings key, value)
+_SETTING_BUTTONS = {
+    "MIN_0": ("min_buy_ton", 0.0),
+    "MIN_0.1": ("min_buy_ton", 0.1),
+    "MIN_0.5": ("min_buy_ton", 0.5),
+    "MIN_1": ("min_buy_ton", 1.0),
+    "MIN_5": ("min_buy_ton", 5.0),
+    "STEP_1": ("strength_step_ton", 1.0),
+    "STEP_5": ("strength_step_ton", 5.0),
+    "STEP_10": ("strength_step_ton", 10.0),
+    "STEP_20": ("strength_step_ton", 20.0),
+    "MAX_10": ("strength_max", 10),
+    "MAX_15": ("strength_max", 15),
+    "MAX_30": ("strength_max", 30),
+    "EMO_GREEN": ("strength_emoji", "🟢"),
+    "EMO_PLANE": ("strength_emoji", "✈️"),
+    "EMO_DIAMOND": ("strength_emoji", "💎"),
+    "SPAM_LOW": ("anti_spam", "LOW"),
+    "SPAM_MED": ("anti_spam", "MED"),
+    "SPAM_HIGH": ("anti_spam", "HIGH"),
+}
 
-    if data.startswith("STEP_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        step = float(data.split("_", 1)[1])
-        s["strength_step_ton"] = step
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+@_admin_only
+async def _btn_setting(update, context, chat, user, data):
+    q = update.callback_query
+    kv = _SETTING_BUTTONS.get(data)
+    if kv is None:
+        return  # stale or malformed button
+    key, value = kv
+    get_group(chat.id)["settings"][key] = value
+    mark_groups_dirty()
+    await send_settings(chat.id, context, q.message, edit=True)
+
+async def _btn_status(update, context, chat, user, data):
+    q = update.callback_query
+    await send_status(chat.id, context, q.message)
 
-    if data.startswith("MAX_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        mx = int(data.split("_", 1)[1])
-        s["strength_max"] = mx
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
+@_admin_only
+async def _btn_remove(update, context, chat, user, data):
+    q = update.callback_query
+    g = get_group(chat.id)
+    if not g.get("token"):
+        await q.message.reply_text("No token configured for this group.")
         return
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Remove", callback_data="CONFIRM_REMOVE")],
+        [InlineKeyboardButton("❌ Cancel", callback_data="CANCEL_REMOVE")]
+    ])
+    await q.message.reply_text("Remove the current token for this group?", reply_markup=kb)
 
-    if data.startswith("EMO_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        if data == "EMO_GREEN":
-            s["strength_emoji"] = "🟢"
-        elif data == "EMO_PLANE":
-            s["strength_emoji"] = "✈️"
-        elif data == "EMO_DIAMOND":
-            s["strength_emoji"] = "💎"
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+@_admin_only
+async def _btn_confirm_remove(update, context, chat, user, data):
+    q = update.callback_query
+    g = get_group(chat.id)
+    g["token"] = None
+    # persisted before confirming, so a restart right after can't bring the token back
+    await flush_groups()
+    await q.message.reply_text("✅ Token removed.")
 
-    if data.startswith("SPAM_"):
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        s = g["settings"]
-        s["anti_spam"] = data.split("_",1)[1]
-        save_groups()
-        await send_settings(chat.id, context, q.message, edit=True)
-        return
+async def _btn_cancel_remove(update, context, chat, user, data):
+    q = update.callback_query
+    await q.message.reply_text("Cancelled.")
+
+_BUTTON_EXACT = {
+    "CFG_PRIVATE": _btn_private_help,
+    "SET_PRIVATE": _btn_private_help,
+    "CFG_GROUP": _btn_cfg_group,
+    "TOKENSET_GROUP": _btn_token_settings,
+    "SET_GROUP": _btn_token_settings,
+    "IMG_SET": _btn_img_set,
+    "IMG_CLEAR": _btn_img_clear,
+    "STATUS_GROUP": _btn_status,
+    "REMOVE_GROUP": _btn_remove,
+    "CONFIRM_REMOVE": _btn_confirm_remove,
+    "CANCEL_REMOVE": _btn_cancel_remove,
+}
+_BUTTON_PREFIX = {
+    "DEX_": _btn_dex_select,
+    "TS_": _btn_token_settings_action,
+    "TOG_": _btn_toggle,
+    "MIN_": _btn_setting,
+    "STEP_": _btn_setting,
+    "MAX_": _btn_setting,
+    "EMO_": _btn_setting,
+    "SPAM_": _btn_setting,
+}
 
-    if data == "STATUS_GROUP":
-        await send_status(chat.id, context, q.message)
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query
+    if not q:
         return
-
-    if data == "REMOVE_GROUP":
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        if not g.get("token"):
-            await q.message.reply_text("No token configured for this group.")
-            return
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Remove", callback_data="CONFIRM_REMOVE")],
-            [InlineKeyboardButton("❌ Cancel", callback_data="CANCEL_REMOVE")]
-        ])
-        await q.message.reply_text("Remove the current token for this group?", reply_markup=kb)
+    await q.answer()
+    chat = q.message.chat if q.message else update.effective_chat
+    user = update.effective_user
+    if not chat or not user:
         return
 
-    if data == "CONFIRM_REMOVE":
-        if not await is_admin(context.bot, chat.id, user.id):
-            await q.answer("Admins only.", show_alert=True)
-            return
-        g = get_group(chat.id)
-        g["token"] = None
-        save_groups()
-        await q.message.reply_text("✅ Token removed.")
-        return
+    data = q.data or ""
+    handler = _BUTTON_EXACT.get(data)
+    if handler is None:
+        handler = _BUTTON_PREFIX.get(data[:data.find("_") + 1])
+    if handler is not None:
+        await handler(update, context, chat, user, data)
+
+# settings keyboard rows that never change (buttons are immutable, so they can be shared)
+_SETTINGS_STATIC_ROWS = (
+    (InlineKeyboardButton("🖼 Set Buy Image", callback_data="IMG_SET"),
+     InlineKeyboardButton("🗑 Clear Image", callback_data="IMG_CLEAR")),
+    (InlineKeyboardButton("Min 0", callback_data="MIN_0"),
+     InlineKeyboardButton("0.1", callback_data="MIN_0.1"),
+     InlineKeyboardButton("0.5", callback_data="MIN_0.5"),
+     InlineKeyboardButton("1", callback_data="MIN_1"),
+     InlineKeyboardButton("5", callback_data="MIN_5")),
+    (InlineKeyboardButton("Step 1", callback_data="STEP_1"),
+     InlineKeyboardButton("5", callback_data="STEP_5"),
+     InlineKeyboardButton("10", callback_data="STEP_10"),
+     InlineKeyboardButton("20", callback_data="STEP_20")),
+    (InlineKeyboardButton("Max 10", callback_data="MAX_10"),
+     InlineKeyboardButton("15", callback_data="MAX_15"),
+     InlineKeyboardButton("30", callback_data="MAX_30")),
+    (InlineKeyboardButton("🟢", callback_data="EMO_GREEN"),
+     InlineKeyboardButton("✈️", callback_data="EMO_PLANE"),
+     InlineKeyboardButton("💎", callback_data="EMO_DIAMOND")),
+    (InlineKeyboardButton("Anti: LOW", callback_data="SPAM_LOW"),
+     InlineKeyboardButton("MED", callback_data="SPAM_MED"),
+     InlineKeyboardButton("HIGH", callback_data="SPAM_HIGH")),
+)
 
-    if data == "CANCEL_REMOVE":
-        await q.message.reply_text("Cancelled.")
-        return
+# (chat_id, message_id) -> hash of the settings text last shown in that message
+_LAST_RENDER: Dict[Tuple[int, int], int] = {}
+_LAST_RENDER_MAX = 1024
+
+def _remember_render(key: Tuple[int, int], digest: int) -> None:
+    _LAST_RENDER.pop(key, None)
+    if len(_LAST_RENDER) >= _LAST_RENDER_MAX:
+        _LAST_RENDER.pop(next(iter(_LAST_RENDER)), None)
+    _LAST_RENDER[key] = digest
+
+_SETTINGS_TMPL = (
+    "*SpyTON BuyBot Settings*\n"
+    "• STON.fi: *%s*\n"
+    "• DeDust: *%s*\n"
+    "• Burst mode: *%s*\n"
+    "• Anti-spam: *%s*\n"
+    "• Min buy (TON): *%s*\n"
+    "• Buy strength: *%s* (%s, step %s TON, max %s)\n"
+    "• Buy image: *%s* (%s)\n"
+)
 
 async def send_settings(chat_id: int, context: ContextTypes.DEFAULT_TYPE, msg, edit: bool=False):
     g = get_group(chat_id)
@@ -1707,53 +2522,51 @@ async def send_settings(chat_id: int, context: ContextTypes.DEFAULT_TYPE, msg, e
     img = "ON ✅" if img_on else "OFF ❌"
     img_note = "set" if img_set else "not set"
 
-    text = (
-        "*SpyTON BuyBot Settings*\n"
-        f"• STON.fi: *{ston}*\n"
-        f"• DeDust: *{dedust}*\n"
-        f"• Burst mode: *{burst}*\n"
-        f"• Anti-spam: *{anti}*\n"
-        f"• Min buy (TON): *{min_buy}*\n"
-        f"• Buy strength: *{strength}* ({strength_emoji}, step {strength_step} TON, max {strength_max})\n"
-        f"• Buy image: *{img}* ({img_note})\n"
+    text = _SETTINGS_TMPL % (
+        ston, dedust, burst, anti, min_buy, strength, strength_emoji, strength_step, strength_max, img, img_note,
     )
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"STON.fi: {ston}", callback_data="TOG_STON"),
-         InlineKeyboardButton(f"DeDust: {dedust}", callback_data="TOG_DEDUST")],
-        [InlineKeyboardButton(f"Burst: {burst}", callback_data="TOG_BURST")],
-        [InlineKeyboardButton(f"Strength: {strength}", callback_data="TOG_STRENGTH"),
-         InlineKeyboardButton(f"Image: {img}", callback_data="TOG_IMAGE")],
-        [InlineKeyboardButton("🖼 Set Buy Image", callback_data="IMG_SET"),
-         InlineKeyboardButton("🗑 Clear Image", callback_data="IMG_CLEAR")],
-        [InlineKeyboardButton("Min 0", callback_data="MIN_0"),
-         InlineKeyboardButton("0.1", callback_data="MIN_0.1"),
-         InlineKeyboardButton("0.5", callback_data="MIN_0.5"),
-         InlineKeyboardButton("1", callback_data="MIN_1"),
-         InlineKeyboardButton("5", callback_data="MIN_5")],
-        [InlineKeyboardButton("Step 1", callback_data="STEP_1"),
-         InlineKeyboardButton("5", callback_data="STEP_5"),
-         InlineKeyboardButton("10", callback_data="STEP_10"),
-         InlineKeyboardButton("20", callback_data="STEP_20")],
-        [InlineKeyboardButton("Max 10", callback_data="MAX_10"),
-         InlineKeyboardButton("15", callback_data="MAX_15"),
-         InlineKeyboardButton("30", callback_data="MAX_30")],
-        [InlineKeyboardButton("🟢", callback_data="EMO_GREEN"),
-         InlineKeyboardButton("✈️", callback_data="EMO_PLANE"),
-         InlineKeyboardButton("💎", callback_data="EMO_DIAMOND")],
-        [InlineKeyboardButton("Anti: LOW", callback_data="SPAM_LOW"),
-         InlineKeyboardButton("MED", callback_data="SPAM_MED"),
-         InlineKeyboardButton("HIGH", callback_data="SPAM_HIGH")],
-    ])
+    # every dynamic button label is also in the text, so the text alone identifies the render
+    digest = hash(text)
+    if edit:
+        key = (msg.chat_id, msg.message_id)
+        if _LAST_RENDER.get(key) == digest:
+            return
+    # only the three ON/OFF rows change; built after the unchanged-render check
+    kb = InlineKeyboardMarkup((
+        (InlineKeyboardButton(f"STON.fi: {ston}", callback_data="TOG_STON"),
+         InlineKeyboardButton(f"DeDust: {dedust}", callback_data="TOG_DEDUST")),
+        (InlineKeyboardButton(f"Burst: {burst}", callback_data="TOG_BURST"),),
+        (InlineKeyboardButton(f"Strength: {strength}", callback_data="TOG_STRENGTH"),
+         InlineKeyboardButton(f"Image: {img}", callback_data="TOG_IMAGE")),
+        *_SETTINGS_STATIC_ROWS,
+    ))
     if edit:
         try:
             await msg.edit_text(text, reply_markup=kb, parse_mode="Markdown")
+            _remember_render(key, digest)
             return
-        except Exception:
-            pass
-    await msg.reply_text(text, reply_markup=kb, parse_mode="Markdown")
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                _remember_render(key, digest)
+                return
+            # message too old / deleted: fall back to sending a fresh one
+    sent = await msg.reply_text(text, reply_markup=kb, parse_mode="Markdown")
+    _remember_render((sent.chat_id, sent.message_id), digest)
 
 
 # -------------------- Crypton-style Token Settings (modules) --------------------
+_TOKEN_SETTINGS_KB = InlineKeyboardMarkup((
+    (InlineKeyboardButton("Min Buy", callback_data="TS_MIN"),
+     InlineKeyboardButton("Emoji", callback_data="TS_EMO")),
+    (InlineKeyboardButton("Manage Media", callback_data="TS_MEDIA"),
+     InlineKeyboardButton("Social Links", callback_data="TS_SOC")),
+    (InlineKeyboardButton("Layout", callback_data="TS_LAYOUT"),
+     InlineKeyboardButton("Bot Preview", callback_data="TS_PREVIEW")),
+    (InlineKeyboardButton("Pause / Resume", callback_data="TS_PAUSE"),
+     InlineKeyboardButton("Remove Token", callback_data="TS_REMOVE")),
+    (InlineKeyboardButton("⬅️ Back", callback_data="TS_BACK"),),
+))
+
 async def send_token_settings(chat_id: int, context: ContextTypes.DEFAULT_TYPE, msg, edit: bool=False):
     g = get_group(chat_id)
     tok = g.get("token") if isinstance(g, dict) else None
@@ -1769,28 +2582,23 @@ async def send_token_settings(chat_id: int, context: ContextTypes.DEFAULT_TYPE,
 
     text = (
         "*Token Settings*\n"
-        f"• Token: *{html.escape(token_name)}*\n"
+        f"• Token: *{_md(token_name)}*\n"
         f"• Min Buy: *{min_buy_disp}*\n"
         f"• Status: *{'PAUSED ⏸️' if paused else 'RUNNING ✅'}*\n\n"
         "Choose a module:"
     )
 
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Min Buy", callback_data="TS_MIN"),
-         InlineKeyboardButton("Emoji", callback_data="TS_EMO")],
-        [InlineKeyboardButton("Manage Media", callback_data="TS_MEDIA"),
-         InlineKeyboardButton("Social Links", callback_data="TS_SOC")],
-        [InlineKeyboardButton("Layout", callback_data="TS_LAYOUT"),
-         InlineKeyboardButton("Bot Preview", callback_data="TS_PREVIEW")],
-        [InlineKeyboardButton("Pause / Resume", callback_data="TS_PAUSE"),
-         InlineKeyboardButton("Remove Token", callback_data="TS_REMOVE")],
-        [InlineKeyboardButton("⬅️ Back", callback_data="TS_BACK")],
-    ])
-
+    # No _LAST_RENDER skip here: the sub-menus edit this same message, so an unchanged
+    # menu text doesn't mean the message still shows it.
     if edit:
-        await msg.edit_text(text, parse_mode="Markdown", reply_markup=kb, disable_web_page_preview=True)
+        try:
+            await msg.edit_text(text, parse_mode="Markdown", reply_markup=_TOKEN_SETTINGS_KB, disable_web_page_preview=True)
+        except BadRequest as e:
+            # double tap on an action that changed nothing
+            if "not modified" not in str(e).lower():
+                raise
     else:
-        await msg.reply_text(text, parse_mode="Markdown", reply_markup=kb, disable_web_page_preview=True)
+        await msg.reply_text(text, parse_mode="Markdown", reply_markup=_TOKEN_SETTINGS_KB, disable_web_page_preview=True)
 
 async def handle_token_settings_button(chat_id: int, data: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -1829,7 +2637,7 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
     if data.startswith("TS_MIN_UNIT_"):
         unit = data.split("_")[-1]
         s["min_buy_unit"] = "USD" if unit == "USD" else "TON"
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1839,7 +2647,7 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
             s["min_buy_usd"] = val
         else:
             s["min_buy_ton"] = val
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1872,26 +2680,26 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
 
     if data == "TS_EMO_TOG":
         s["strength_on"] = not bool(s.get("strength_on", True))
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
     if data.startswith("TS_EMO_SET_"):
         k = data.split("_")[-1]
         s["strength_emoji"] = "🟢" if k == "GREEN" else ("💎" if k == "DIAMOND" else "✈️")
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
     if data.startswith("TS_EMO_STEP_"):
         s["strength_step_ton"] = float(data.split("_")[-1])
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
     if data.startswith("TS_EMO_MAX_"):
         s["strength_max"] = int(data.split("_")[-1])
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1915,7 +2723,7 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
 
     if data == "TS_MEDIA_TOG":
         s["buy_image_on"] = not bool(s.get("buy_image_on", False))
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1941,14 +2749,14 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
 
     if data == "TS_SOC_SET_TG":
         # Ask in DM for safety (Telegram blocks some group flows)
-        AWAITING_SOCIAL[update.effective_user.id] = {"chat_id": chat_id, "field": "telegram"}
+        AWAITING_SOCIAL[update.effective_user.id] = AwaitSocial(chat_id, "telegram")
         await msg.reply_text("Send the token Telegram link now in DM (example: https://t.me/YourToken).")
         return
 
     if data == "TS_SOC_CLR_TG":
         if isinstance(tok, dict):
             tok["telegram"] = ""
-            save_groups()
+            mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1968,7 +2776,7 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
     if data.startswith("TS_LAYOUT_TOG_"):
         key = data.split("_", 3)[3]
         s[key] = not bool(s.get(key, True))
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -1990,7 +2798,7 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
             return
         tok["paused"] = not bool(tok.get("paused", False))
         tok["init_done"] = False  # baseline after resume
-        save_groups()
+        mark_groups_dirty()
         await send_token_settings(chat_id, context, msg, edit=True)
         return
 
@@ -2008,24 +2816,31 @@ async def handle_token_settings_button(chat_id: int, data: str, update: Update,
 
     if data == "TS_REMOVE_CONFIRM":
         g["token"] = None
-        save_groups()
+        # persisted before confirming, so a restart right after can't bring the token back
+        await flush_groups()
         await msg.edit_text("✅ Token removed.")
         return
 
+_STATUS_TMPL = (
+    "📊 *Status*\n"
+    "Token: *{symbol}*\n"
+    "Address: `{address}`\n"
+    "STON pool: `{ston}`\n"
+    "DeDust pool: `{dedust}`\n"
+)
 async def send_status(chat_id: int, context: ContextTypes.DEFAULT_TYPE, msg):
     g = get_group(chat_id)
     token = g.get("token")
     if not token:
         await msg.reply_text("No token configured. Tap *Configure Token*.", parse_mode="Markdown")
         return
-    await msg.reply_text(
-        "📊 *Status*\n"
-        f"Token: *{token.get('symbol') or token.get('name') or 'UNKNOWN'}*\n"
-        f"Address: `{token.get('address')}`\n"
-        f"STON pool: `{token.get('ston_pool') or 'NONE'}`\n"
-        f"DeDust pool: `{token.get('dedust_pool') or 'NONE'}`\n",
-        parse_mode="Markdown"
-    )
+    fields = {
+        "symbol": _md(token.get("symbol") or token.get("name") or "UNKNOWN"),
+        "address": token.get("address") or "NONE",
+        "ston": token.get("ston_pool") or "NONE",
+        "dedust": token.get("dedust_pool") or "NONE",
+    }
+    await msg.reply_text(_STATUS_TMPL.format_map(fields), parse_mode="Markdown")
 
 # -------------------- TOKEN AUTO-DETECT --------------------
 def detect_token_address(text: str) -> Optional[str]:
@@ -2035,46 +2850,179 @@ def detect_token_address(text: str) -> Optional[str]:
     TON user-friendly base64url addresses are 48 chars long (EQ.. / UQ..).
     We normalize to the canonical 48-char form so pool lookup doesn't fail.
     """
-    m = JETTON_RE.search(text or "")
-    if not m:
-        return None
-    cand = (m.group(1) or "").strip()
-    # Canonical TON user-friendly address length is 48.
-    if len(cand) >= 48:
-        cand = cand[:48]
-    # Final sanity: must start with EQ/UQ and be urlsafe-base64-ish
-    if not (cand.startswith("EQ") or cand.startswith("UQ")):
+    span = _find_jetton_id(text or "")
+    if span is None:
         return None
-    if not re.fullmatch(r"[A-Za-z0-9_-]{48}", cand):
+    # canonical TON user-friendly address length is 48.
+    cand = text[span[0]:span[1]][:48]
+    if len(cand) != 48:
         return None
-    return cand
+    return _canon_addr(cand)
 
-def _dex_pair_lookup(pair_id: str) -> Optional[Dict[str, Any]]:
-    """Return Dexscreener pair payload (TON) for a given pair/pool id."""
+def _find_jetton_id(text: str) -> Optional[Tuple[int, int]]:
+    """Span of the first `\b[EU]Q[A-Za-z0-9_-]{40,80}\b` (ASCII) match in text, without the regex engine.
+
+    str.find jumps between EQ/UQ candidates in C, so a message without an address costs two
+    scans; each candidate then checks its base64url run and picks the longest end that falls
+    on a word boundary, exactly as the pattern would.
+    """
+    n = len(text)
+    word = _WORD_CHARS
+    pos = 0
+    while True:
+        e = text.find("EQ", pos)
+        u = text.find("UQ", pos)
+        if e < 0 and u < 0:
+            return None
+        i = e if u < 0 or 0 <= e < u else u
+        pos = i + 1
+        if i and text[i - 1] in word:
+            continue  # no \b before the prefix
+        j, lim = i + 2, min(n, i + 82)
+        while j < lim and text[j] in _B64URL_CHARS:
+            j += 1
+        for k in range(j, i + 41, -1):
+            if (text[k - 1] in word) != (k < n and text[k] in word):
+                return i, k
+
+DEX_SLOW_SEC = 2.0  # pair lookups slower than this are logged
+
+@dataclass(frozen=True, slots=True)
+class PairMini:
+    """The two legs of a Dexscreener pair; all the pair lookups' callers read."""
+    base_sym: str
+    base_addr: str
+    quote_sym: str
+    quote_addr: str
+
+    @classmethod
+    def from_pair(cls, p: Dict[str, Any]) -> "PairMini":
+        base = p.get("baseToken") or {}
+        quote = p.get("quoteToken") or {}
+        return cls(
+            str(base.get("symbol") or "").upper(), str(base.get("address") or "").strip(),
+            str(quote.get("symbol") or "").upper(), str(quote.get("address") or "").strip(),
+        )
+
+def _dex_pair_lookup(pair_id: str) -> Optional[PairMini]:
+    """Return the legs of the Dexscreener pair (TON) for a given pair/pool id.
+
+    Only the four leg fields are kept, so the cached value doesn't pin the full payload
+    (price history, liquidity, txns...).
+    """
     pair_id = (pair_id or "").strip()
     if not pair_id:
         return None
     url = f"{DEX_PAIR_URL}/ton/{pair_id}"
+    t0 = time.monotonic()
     try:
-        res = requests.get(url, timeout=20)
+        # a user is waiting on this one: 2s to connect, 3s between bytes, else give up
+        res = _shared_get("dexscreener", url, timeout=(2, 3))
+        took = time.monotonic() - t0
+        if took > DEX_SLOW_SEC:
+            log.warning("Slow Dexscreener pair lookup: %s took %.1fs (status %s)", pair_id, took, res.status_code)
         if res.status_code != 200:
+            if res.status_code == 404:
+                _meta_cache_put("dex_pair", pair_id, _META_MISS)
+            return None
+        js = orjson.loads(res.content)
+        pair = js.get("pair") or js.get("pairs")
+        if isinstance(pair, list):
+            # Some responses use "pairs" list
+            pair = pair[0] if pair else None
+        if not isinstance(pair, dict):
+            # a definite "no such pair" (e.g. a jetton address pasted as a pool); errors aren't cached
+            _meta_cache_put("dex_pair", pair_id, _META_MISS)
             return None
-        js = res.json()
-        pairs = js.get("pair") or js.get("pairs")
-        if isinstance(pairs, list) and pairs:
-            return pairs[0] if isinstance(pairs[0], dict) else None
-        if isinstance(pairs, dict):
-            return pairs
-        # Some responses use "pairs" list
-        if isinstance(js.get("pairs"), list) and js.get("pairs"):
-            p0 = js.get("pairs")[0]
-            return p0 if isinstance(p0, dict) else None
+        return PairMini.from_pair(pair)
+    except requests.Timeout:
+        log.warning("Dexscreener pair lookup timed out: %s after %.1fs", pair_id, time.monotonic() - t0)
         return None
     except Exception:
         return None
 
-def resolve_jetton_from_text_sync(text: str) -> Optional[str]:
-    """Resolve a jetton master address from either a jetton address or supported pool/link."""
+# pair_id -> future of the in-flight Dexscreener lookup (singleflight)
+_pair_inflight: Dict[str, asyncio.Future] = {}
+
+async def dex_pair_lookup(pair_id: str) -> Optional[PairMini]:
+    """Async `_dex_pair_lookup` that coalesces concurrent calls for the same pair.
+
+    A burst of buys for one pool would otherwise fire identical Dexscreener
+    requests before the first one lands; later callers await the first fetch.
+    Found pairs are then served from the meta cache for DEX_PAIRS_TTL, and ids Dexscreener
+    doesn't know are answered as misses for META_MISS_TTL.
+    """
+    pair_id = (pair_id or "").strip()
+    if not pair_id:
+        return None
+    hit = _meta_cache_get("dex_pair", pair_id, DEX_PAIRS_TTL)
+    if hit is _META_MISS:
+        return None
+    if hit is not None:
+        return hit
+    fut = _pair_inflight.get(pair_id)
+    if fut is not None:
+        # shielded: a cancelled follower must not cancel the shared future for everyone
+        return await asyncio.shield(fut)
+    fut = asyncio.get_running_loop().create_future()
+    _pair_inflight[pair_id] = fut
+    meta = None
+    try:
+        meta = await _to_thread(_dex_pair_lookup, pair_id)
+        if meta is not None:
+            _meta_cache_put("dex_pair", pair_id, meta)
+    finally:
+        _pair_inflight.pop(pair_id, None)
+        if not fut.done():
+            fut.set_result(meta)
+    return meta
+
+def _pick_non_ton(p: PairMini, best_effort: bool = False) -> str:
+    """Jetton side of a Dexscreener TON pair ("" if neither side is TON, unless best_effort)."""
+    if p.quote_addr and p.base_sym in _TON_SYMBOLS:
+        return _canon_addr(p.quote_addr)
+    if p.base_addr and p.quote_sym in _TON_SYMBOLS:
+        return _canon_addr(p.base_addr)
+    return _canon_addr(p.base_addr or p.quote_addr) if best_effort else ""
+
+RESOLVE_RACE_SEC = 4.0
+
+async def _pool_or_jetton(addr: str) -> Optional[str]:
+    """Jetton for an id that is either a pool or a jetton master, from whichever source answers first.
+
+    Dexscreener knows it as a pair (-> its non-TON side) or TonAPI knows it as a jetton
+    (-> the id itself); a slow source no longer holds up the reply.
+    """
+    async def as_pool() -> str:
+        # shielded: a lost race still lets the lookup finish and land in the pair cache
+        p = await asyncio.shield(dex_pair_lookup(addr))
+        return _pick_non_ton(p) if p else ""
+
+    async def as_jetton() -> str:
+        info = await _to_thread(tonapi_jetton_info, addr)
+        return addr if (info.get("name") or info.get("symbol")) else ""
+
+    pending = {asyncio.create_task(as_pool()), asyncio.create_task(as_jetton())}
+    deadline = time.monotonic() + RESOLVE_RACE_SEC
+    try:
+        while pending:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=left, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result():
+                    return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    return None
+
+async def resolve_jetton_from_text(text: str) -> Optional[str]:
+    """Resolve a jetton master address from either a jetton address or supported pool/link.
+
+    Parsing runs inline; only the Dexscreener pair lookup leaves the loop.
+    """
     t = (text or "").strip()
     if not t:
         return None
@@ -2083,54 +3031,33 @@ def resolve_jetton_from_text_sync(text: str) -> Optional[str]:
     direct = detect_token_address(t)
     if direct:
         # If it *looks* like a pool link context, try pair lookup first
-        if "pool" in t.lower() or "pools" in t.lower() or "geckoterminal" in t.lower() or "dexscreener" in t.lower():
-            p = _dex_pair_lookup(direct)
-            if p:
-                base = p.get("baseToken") or {}
-                quote = p.get("quoteToken") or {}
-                base_sym = str(base.get("symbol") or "").upper()
-                quote_sym = str(quote.get("symbol") or "").upper()
-                base_addr = str(base.get("address") or "")
-                quote_addr = str(quote.get("address") or "")
-                if base_sym in ("TON","WTON") and quote_addr:
-                    return quote_addr
-                if quote_sym in ("TON","WTON") and base_addr:
-                    return base_addr
+        if POOL_HINT_RE.search(t):
+            picked = await _pool_or_jetton(direct)
+            if picked:
+                return picked
         return direct
 
     # 2) GeckoTerminal / Dexscreener / ston.fi / dedust.io pool links
-    pair_id = None
-    for rx in (GECKO_POOL_RE, DEXSCREENER_PAIR_RE, STON_POOL_RE, DEDUST_POOL_RE):
-        m = rx.search(t)
-        if m:
-            pair_id = m.group(1)
-            break
-
     # 3) Fallback: if the message contains a single EQ/UQ-like id, attempt using it as pair id
-    if not pair_id:
-        m = JETTON_RE.search(t)
-        if m:
-            pair_id = m.group(1)
+    # One scan for both: the first link wins, else the first bare id.
+    pair_id = None
+    bare_id = None
+    for m in LINK_RE.finditer(t):
+        if m.lastgroup == "jetton":
+            bare_id = bare_id or m.group("jetton")
+            continue
+        pair_id = m.group(m.lastgroup)
+        break
+    pair_id = pair_id or bare_id
 
     if not pair_id:
         return None
 
-    p = _dex_pair_lookup(pair_id)
+    p = await dex_pair_lookup(pair_id)
     if not p:
         return None
-    base = p.get("baseToken") or {}
-    quote = p.get("quoteToken") or {}
-    base_sym = str(base.get("symbol") or "").upper()
-    quote_sym = str(quote.get("symbol") or "").upper()
-    base_addr = str(base.get("address") or "")
-    quote_addr = str(quote.get("address") or "")
-    # choose the non-TON side
-    if base_sym in ("TON","WTON") and quote_addr:
-        return quote_addr
-    if quote_sym in ("TON","WTON") and base_addr:
-        return base_addr
     # if neither side says TON, still return base (best-effort)
-    return base_addr or quote_addr or None
+    return _pick_non_ton(p, best_effort=True) or None
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.effective_chat or not update.effective_user:
@@ -2141,12 +3068,12 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
     # Social link input (Token Settings -> Social Links)
-    if user.id in AWAITING_SOCIAL:
-        cfg = AWAITING_SOCIAL.get(user.id) or {}
-        target_chat_id = int(cfg.get("chat_id") or 0)
-        field = str(cfg.get("field") or "telegram")
+    cfg_social = AWAITING_SOCIAL.get(user.id)
+    if cfg_social is not None:
+        target_chat_id = cfg_social.chat_id
+        field = cfg_social.field
         if field == "telegram":
-            m = re.search(r"https?://t\.me/[A-Za-z0-9_]{3,}(?:\S*)?", text)
+            m = TG_LINK_RE.search(text)
             if not m:
                 await update.message.reply_text("Send a valid Telegram link like: https://t.me/YourToken")
                 return
@@ -2155,7 +3082,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             tok = g.get("token") or {}
             if isinstance(tok, dict):
                 tok["telegram"] = tg_url
-                save_groups()
+                mark_groups_dirty()
             AWAITING_SOCIAL.pop(user.id, None)
             await update.message.reply_text("✅ Token Telegram link saved.")
             return
@@ -2163,14 +3090,14 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Resolve either a jetton address or a supported link (GT / DexScreener / STON / DeDust)
-    addr = await _to_thread(resolve_jetton_from_text_sync, text)
+    addr = await resolve_jetton_from_text(text)
     if not addr:
         return
 
     # Optional: token telegram link can be sent together with CA.
     # Example: EQ... https://t.me/YourToken
     tg_url = ""
-    m_tg = re.search(r"https?://t\.me/[A-Za-z0-9_]{3,}(?:\S*)?", text)
+    m_tg = TG_LINK_RE.search(text)
     if m_tg:
         tg_url = m_tg.group(0).strip()
 
@@ -2181,15 +3108,11 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not cfg:
             await update.message.reply_text("Add the bot to your group, then tap *Configure Token* in that group.", parse_mode="Markdown")
             return
-        if isinstance(cfg, dict):
-            if cfg.get("stage") != "CA":
-                await update.message.reply_text("Tap *Configure Token* again and choose a DEX first.", parse_mode="Markdown")
-                return
-            target_chat_id = int(cfg.get("group_id") or 0)
-            dex_mode = str(cfg.get("dex") or "").strip() or "both"
-        else:
-            target_chat_id = int(cfg)
-            dex_mode = "both"
+        if cfg.stage != "CA":
+            await update.message.reply_text("Tap *Configure Token* again and choose a DEX first.", parse_mode="Markdown")
+            return
+        target_chat_id = cfg.group_id
+        dex_mode = cfg.dex.strip() or "both"
         if not target_chat_id:
             await update.message.reply_text("Tap *Configure Token* again in your group.", parse_mode="Markdown")
             return
@@ -2224,39 +3147,67 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat.type in ("group", "supergroup") and chat.id != target_chat_id:
         return
 
-    # In private, we trust the stored target_chat_id.
-    if not await is_admin(context.bot, target_chat_id, user.id):
-        AWAITING_IMAGE.pop(user.id, None)
-        return
-
     photos = update.message.photo or []
     if not photos:
         return
 
+    # In private, we trust the stored target_chat_id. is_admin is served from the
+    # cached admin set, so this is normally a dict lookup rather than an API call.
+    if not await is_admin(context.bot, target_chat_id, user.id):
+        AWAITING_IMAGE.pop(user.id, None)
+        return
+
     file_id = photos[-1].file_id  # largest
     g = get_group(target_chat_id)
     g["settings"]["buy_image_file_id"] = file_id
     g["settings"]["buy_image_on"] = True
-    save_groups()
+    mark_groups_dirty()
     AWAITING_IMAGE.pop(user.id, None)
 
     await update.message.reply_text("✅ Buy image saved. Image mode is now ON.")
 
+# Replace confirmations waiting for a button press, keyed by a short random token.
+# The token keeps callback_data well under Telegram's 64-byte limit (a supergroup id
+# plus a 48-char address did not fit); abandoned prompts expire after REPLACE_TTL.
+_PENDING_REPL: Dict[str, Dict[str, Any]] = {}
+REPLACE_TTL = 600
+
+def _pending_replace_put(chat_id: int, jetton: str, reply_to_chat: int, telegram: str, dex_mode: str) -> str:
+    now = time.time()
+    for k in [k for k, v in _PENDING_REPL.items() if now - v["ts"] >= REPLACE_TTL]:
+        _PENDING_REPL.pop(k, None)
+    tok = secrets.token_urlsafe(8)
+    _PENDING_REPL[tok] = {
+        "chat_id": chat_id, "jetton": jetton, "reply_to_chat": reply_to_chat,
+        "telegram": telegram, "dex_mode": dex_mode, "ts": now,
+    }
+    return tok
+
+def _pending_replace_get(tok: str) -> Optional[Dict[str, Any]]:
+    p = _PENDING_REPL.get(tok)
+    if p and time.time() - p["ts"] < REPLACE_TTL:
+        return p
+    _PENDING_REPL.pop(tok, None)
+    return None
+
 async def configure_group_token(chat_id: int, jetton: str, context: ContextTypes.DEFAULT_TYPE, reply_to_chat: int, telegram: str = "", dex_mode: str = "both"):
     g = get_group(chat_id)
+    jetton = _canon_addr(jetton)
     # 1 token per group: confirm replace if exists and different
     existing = g.get("token") or None
+    same = bool(existing) and _canon_addr(existing.get("address") or "") == jetton
     # Same token: allow updating telegram link without replacing anything.
-    if existing and existing.get("address") == jetton and telegram:
+    if same and telegram:
         existing["telegram"] = telegram
-        save_groups()
+        mark_groups_dirty()
         await context.bot.send_message(chat_id=reply_to_chat, text="✅ Token Telegram link updated.")
         return
-    if existing and existing.get("address") != jetton:
+    if existing and not same:
         # Ask confirmation
+        tok = _pending_replace_put(chat_id, jetton, reply_to_chat, telegram, dex_mode)
         kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Replace", callback_data=f"REPL_{chat_id}_{jetton}")],
-            [InlineKeyboardButton("❌ Cancel", callback_data="CANCEL_REPL")]
+            [InlineKeyboardButton("✅ Replace", callback_data=f"REPL_{tok}")],
+            [InlineKeyboardButton("❌ Cancel", callback_data=f"CANCEL_REPL_{tok}")]
         ])
         await context.bot.send_message(
             chat_id=reply_to_chat,
@@ -2279,108 +3230,109 @@ async def on_replace_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     data = q.data or ""
     if data.startswith("REPL_"):
-        # REPL_chatid_jetton
-        parts = data.split("_", 2)
-        if len(parts) != 3:
+        # REPL_<token>
+        pending = _pending_replace_get(data[len("REPL_"):])
+        if not pending:
+            await q.answer("This request expired. Send the token again.", show_alert=True)
             return
-        target_chat_id = int(parts[1])
-        jetton = parts[2]
-        # ensure pressing inside that group and admin
-        if chat.id != target_chat_id:
+        target_chat_id = pending["chat_id"]
+        # ensure pressing where the prompt was sent, by an admin of the target group
+        if chat.id not in (target_chat_id, pending["reply_to_chat"]):
             await q.answer("Open this in the target group.", show_alert=True)
             return
-        if not await is_admin(context.bot, chat.id, user.id):
+        if not await is_admin(context.bot, target_chat_id, user.id):
             await q.answer("Admins only.", show_alert=True)
             return
-        await _set_token_now(target_chat_id, jetton, context, chat.id)
+        _PENDING_REPL.pop(data[len("REPL_"):], None)
+        await _set_token_now(target_chat_id, pending["jetton"], context, chat.id,
+                             telegram=pending["telegram"], dex_mode=pending["dex_mode"])
         try:
             await q.message.delete()
-        except Exception:
-            pass
+        except BadRequest:
+            pass  # already gone or too old to delete
         return
 
-    if data == "CANCEL_REPL":
+    if data.startswith("CANCEL_REPL"):
+        _PENDING_REPL.pop(data[len("CANCEL_REPL_"):], None)
         await q.message.reply_text("Cancelled.")
         return
 
 async def _set_token_now(chat_id: int, jetton: str, context: ContextTypes.DEFAULT_TYPE, reply_chat_id: int, telegram: str = "", dex_mode: str = "both"):
-    # Token metadata (GeckoTerminal first, then TonAPI, then DexScreener)
-    gk = gecko_token_info(jetton)
-    name = (gk.get("name") or "").strip() if gk else ""
-    sym = (gk.get("symbol") or "").strip() if gk else ""
-    if not name and not sym:
-        info = tonapi_jetton_info(jetton)
-        name = (info.get("name") or "").strip()
-        sym = (info.get("symbol") or "").strip()
-    if not name and not sym:
-        dx = dex_token_info(jetton)
-        name = (dx.get("name") or "").strip()
-        sym = (dx.get("symbol") or "").strip()
+    jetton = _canon_addr(jetton)
     dex_mode = (dex_mode or "both").lower().strip()
+
+    async def _none():
+        return None
+    # The lookups are independent, so they run together: GeckoTerminal, TonAPI (names, holders,
+    # decimals), DexScreener names and pool discovery (the DexScreener ones share one response).
+    # A failing source just counts as empty rather than aborting the setup.
+    results = await asyncio.gather(
+        _to_thread(gecko_token_info, jetton),
+        _to_thread(tonapi_jetton_info, jetton),
+        _to_thread(dex_token_info, jetton),
+        _to_thread(find_stonfi_ton_pair_for_token, jetton) if dex_mode in ("both","ston","stonfi") else _none(),
+        _to_thread(find_dedust_ton_pair_for_token, jetton) if dex_mode in ("both","dedust") else _none(),
+        return_exceptions=True,
+    )
+    for r in results:
+        if isinstance(r, Exception):
+            log.warning("token setup lookup failed for %s: %s", jetton, r)
+    gk, info, dx, ston_pool, dedust_pool = (None if isinstance(r, Exception) else r for r in results)
+    info = info or {}
+
+    # Token metadata (GeckoTerminal first, then TonAPI, then DexScreener)
+    name = sym = ""
+    for src in (gk, info, dx):
+        if src:
+            name = (src.get("name") or "").strip()
+            sym = (src.get("symbol") or "").strip()
+            if name or sym:
+                break
     # Seed holders once at setup so first buys show holders immediately.
     holders_seed: Optional[int] = None
     try:
-        info_h = tonapi_jetton_info(jetton)
-        hh = info_h.get("holders_count")
+        hh = info.get("holders_count")
         if hh is not None:
             holders_seed = int(hh)
     except Exception:
         pass
     if holders_seed is None:
         try:
-            hh2 = tonapi_jetton_holders_count(jetton)
+            hh2 = await _to_thread(tonapi_jetton_holders_count, jetton)
             if hh2 is not None:
                 holders_seed = int(hh2)
         except Exception:
             pass
-    # decimals for correct amount formatting
+    # decimals for correct amount formatting (served from the TonAPI answer above)
     decimals_seed: int = 9
     try:
-        meta_j = get_jetton_meta(jetton)
+        meta_j = await _to_thread(get_jetton_meta, jetton)
         decimals_seed = int(meta_j.get("decimals") or 9)
     except Exception:
         decimals_seed = 9
 
-    ston_pool = find_stonfi_ton_pair_for_token(jetton) if dex_mode in ("both","ston","stonfi") else None
-    dedust_pool = find_dedust_ton_pair_for_token(jetton) if dex_mode in ("both","dedust") else None
-
     # If the user pasted a non-canonical address (e.g. a site-added suffix like "-Lone"),
     # we can still recover the correct jetton master from the resolved pool metadata.
     # This prevents "pool found but no buys" situations caused by address mismatches.
     if dedust_pool:
         try:
-            p = _dex_pair_lookup(dedust_pool)
-            if isinstance(p, dict):
-                base = p.get("baseToken") or {}
-                quote = p.get("quoteToken") or {}
-                base_sym = str(base.get("symbol") or "").upper()
-                quote_sym = str(quote.get("symbol") or "").upper()
-                base_addr = str(base.get("address") or "").strip()
-                quote_addr = str(quote.get("address") or "").strip()
-                recovered = ""
-                if base_sym in ("TON", "WTON") and quote_addr:
-                    recovered = quote_addr
-                elif quote_sym in ("TON", "WTON") and base_addr:
-                    recovered = base_addr
-                elif base_addr:
-                    recovered = base_addr
-                elif quote_addr:
-                    recovered = quote_addr
-
+            p = await dex_pair_lookup(dedust_pool)
+            if p is not None:
+                recovered = _pick_non_ton(p, best_effort=True)
                 if recovered and recovered != jetton:
                     log.warning("Jetton address corrected via pool metadata: %s -> %s", jetton, recovered)
                     jetton = recovered
 
                     # Refresh metadata using the corrected address (best-effort).
-                    gk2 = gecko_token_info(jetton)
+                    gk2 = await _to_thread(gecko_token_info, jetton)
                     name2 = (gk2.get("name") or "").strip() if gk2 else ""
                     sym2 = (gk2.get("symbol") or "").strip() if gk2 else ""
                     if not name2 and not sym2:
-                        info2 = tonapi_jetton_info(jetton)
+                        info2 = await _to_thread(tonapi_jetton_info, jetton)
                         name2 = (info2.get("name") or "").strip()
                         sym2 = (info2.get("symbol") or "").strip()
                     if not name2 and not sym2:
-                        dx2 = dex_token_info(jetton)
+                        dx2 = await _to_thread(dex_token_info, jetton)
                         name2 = (dx2.get("name") or "").strip()
                         sym2 = (dx2.get("symbol") or "").strip()
                     if name2 or sym2:
@@ -2423,10 +3375,9 @@ async def _set_token_now(chat_id: int, jetton: str, context: ContextTypes.DEFAUL
         "last_dedust_trade": None,
         "ston_last_block": None,
         "ignore_before_ts": int(time.time()),
-        "burst": {"window_start": int(time.time()), "count": 0},
         "telegram": telegram.strip() if telegram else "",
     }
-    save_groups()
+    mark_groups_dirty()
 
     # Prevent posting old buys right after configuration
     await warmup_seen_for_chat(chat_id, ston_pool, dedust_pool)
@@ -2435,14 +3386,14 @@ async def _set_token_now(chat_id: int, jetton: str, context: ContextTypes.DEFAUL
         g2 = get_group(chat_id)
         if isinstance(g2.get('token'), dict):
             g2['token']['init_done'] = True
-            save_groups()
+            mark_groups_dirty()
     except Exception:
         pass
 
     disp = sym or name or "TOKEN"
     msg = (
         f"✅ *Token Added*\n"
-        f"• Token: *{html.escape(disp)}*\n"
+        f"• Token: *{_md(disp)}*\n"
         f"• Address: `{jetton}`\n"
         f"• STON.fi pool: `{ston_pool or 'NONE'}`\n"
         f"• DeDust pool: `{dedust_pool or 'NONE'}`\n\n"
@@ -2468,408 +3419,599 @@ async def _set_token_now(chat_id: int, jetton: str, context: ContextTypes.DEFAUL
 async def _to_thread(fn, *args, **kwargs):
     return await asyncio.to_thread(fn, *args, **kwargs)
 
-async def poll_once(app: Application):
-    # Collect all groups with configured token
-    items: List[Tuple[int, Dict[str, Any]]] = []
-    for k, g in GROUPS.items():
-        if not isinstance(g, dict):
-            continue
-        token = g.get("token")
-        if not isinstance(token, dict):
-            continue
-        items.append((int(k), g))
+@dataclass(slots=True)
+class BurstState:
+    window_start: int
+    count: int = 0
+
+# Anti-spam window per chat. In memory only (like _POLL_STATE); keeping it out of the
+# token dict means a post doesn't dirty the group's stored config, and a restart just
+# opens a fresh window.
+_BURST_STATE: Dict[int, BurstState] = {}
+
+# chat_id -> consecutive polls where the STON export feed had no buy for the chat's pool.
+# The TonAPI v2 fallback only runs once this reaches STON_FALLBACK_AFTER; a pool the
+# fallback does find new buys for stays at the threshold, so v2-only pools are checked every poll.
+_STON_MISS: Dict[int, int] = {}
+STON_FALLBACK_AFTER = 3
+# pool -> when its fallback last found nothing new. A quiet pool's last 15 txs don't change,
+# so the fallback isn't re-run for it (by any group) within STON_FALLBACK_IDLE_SEC; the
+# account-feed cache only spans a single poll.
+_STON_FALLBACK_IDLE: Dict[str, float] = {}
+STON_FALLBACK_IDLE_SEC = 30
+
+def _ston_window(token: Dict[str, Any], latest: int) -> Tuple[int, int]:
+    """(from_block, to_block) still to scan for a token's STON cursor."""
+    # per-token cursor to avoid posting old swaps when a new group configures a token
+    last_block = token.get("ston_last_block")
+    if last_block is None:
+        # initialize slightly behind to avoid missing
+        last_block = max(0, int(latest) - 5)
+    from_b = int(last_block) + 1
+    to_b = int(latest)
+    # cap range to avoid huge pulls (see STON_MAX_CATCHUP_BLOCKS)
+    if to_b - from_b > STON_MAX_CATCHUP_BLOCKS:
+        log.warning("STON cursor %s blocks behind for %s; skipping blocks %s-%s",
+                    to_b - from_b, token.get("address"), from_b, to_b - STON_MAX_CATCHUP_BLOCKS - 1)
+        from_b = to_b - STON_MAX_CATCHUP_BLOCKS
+    return from_b, to_b
+
+def _ston_ev_block(ev: Dict[str, Any]) -> Optional[int]:
+    b = ev.get("block")
+    v = b.get("blockNumber") if isinstance(b, dict) else ev.get("blockNumber")
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+@dataclass(slots=True)
+class StonCycle:
+    """One poll cycle's STON export events, fetched once for every polled pool and indexed by pool."""
+    latest: int
+    pools: frozenset  # pools the window was fetched for
+    by_pool: Dict[str, List[Dict[str, Any]]]
+
+    def events(self, pool: str, from_b: int, to_b: int) -> List[Dict[str, Any]]:
+        # the shared window starts at the oldest cursor; trim to this token's own range
+        out = []
+        for ev in self.by_pool.get(pool, ()):
+            b = _ston_ev_block(ev)
+            if b is None or from_b <= b <= to_b:
+                out.append(ev)
+        return out
+
+async def _ston_cycle(items: List[Tuple[int, Dict[str, Any]]]) -> Optional[StonCycle]:
+    """Fetch the STON export window covering every polled group's cursor in one go.
 
-    # For each group, poll its pools
-    for chat_id, g in items:
+    Groups each used to pull the same block range (the feed can't be filtered server-side),
+    so N groups downloaded every event N times. None if nothing to fetch or the fetch failed;
+    groups then fall back to their own request.
+    """
+    tokens = []
+    for _, g in items:
         token = g["token"]
         settings = g.get("settings") or DEFAULT_SETTINGS
-
-        # Pause / resume
-        if bool(token.get("paused", False)):
+        if (settings.get("enable_ston", True) and token.get("ston_pool") and token.get("init_done")
+                and not token.get("paused", False)):
+            tokens.append(token)
+    if not tokens:
+        return None
+    latest = await _to_thread(ston_latest_block)
+    if latest is None:
+        return None
+    latest = int(latest)
+    pools = frozenset(t["ston_pool"] for t in tokens)
+    from_b = min(_ston_window(t, latest)[0] for t in tokens)
+    if from_b > latest:
+        return StonCycle(latest, pools, {})
+    evs = await ston_events_range(from_b, latest, pools)
+    if evs is None:
+        return None
+    by_pool: Dict[str, List[Dict[str, Any]]] = {}
+    for ev in evs:
+        if str(ev.get("eventType") or "").lower() != "swap":
             continue
+        by_pool.setdefault(str(ev.get("pairId") or "").strip(), []).append(ev)
+    return StonCycle(latest, pools, by_pool)
 
-        # One-time initialization per chat to prevent "old buys" spam.
-        # If the bot restarts or a token was configured long ago, we warm up cursors/seen once
-        # and skip posting on that first cycle.
-        if not token.get("init_done"):
-            try:
-                await warmup_seen_for_chat(chat_id, token.get("ston_pool"), token.get("dedust_pool"))
-            except Exception:
-                pass
-            token["init_done"] = True
-            save_groups()
-            continue
+async def _poll_group(app: Application, chat_id: int, g: Dict[str, Any], ston: Optional[StonCycle] = None) -> bool:
+    """Poll one group's STON/DeDust pools and post new buys. Returns True if anything was posted.
 
-        min_buy = float(min_buy_ton_threshold(settings))
-        anti = (settings.get("anti_spam") or "MED").upper()
-        max_msgs, window = anti_spam_limit(anti)
+    `ston` is the cycle's shared STON window; without it the group fetches its own.
+    """
+    token = g["token"]
+    settings = g.get("settings") or DEFAULT_SETTINGS
 
-        burst = token.setdefault("burst", {"window_start": int(time.time()), "count": 0})
-        now = int(time.time())
-        if now - int(burst.get("window_start", now)) > window:
-            burst["window_start"] = now
-            burst["count"] = 0
+    # Pause / resume
+    if bool(token.get("paused", False)):
+        return False
 
-        # STON (STON exported events by blocks)
-        if settings.get("enable_ston", True) and token.get("ston_pool"):
-            pool = token["ston_pool"]
-            try:
+    # One-time initialization per chat to prevent "old buys" spam.
+    # If the bot restarts or a token was configured long ago, we warm up cursors/seen once
+    # and skip posting on that first cycle.
+    if not token.get("init_done"):
+        try:
+            await warmup_seen_for_chat(chat_id, token.get("ston_pool"), token.get("dedust_pool"))
+        except Exception:
+            pass
+        token["init_done"] = True
+        mark_groups_dirty()
+        # just configured: keep polling at the base rate
+        return True
+
+    min_buy = float(await _to_thread(min_buy_ton_threshold, settings))
+    anti = (settings.get("anti_spam") or "MED").upper()
+    max_msgs, window = anti_spam_limit(anti)
+
+    burst = _BURST_STATE.get(chat_id)
+    now = int(time.time())
+    if burst is None:
+        burst = _BURST_STATE[chat_id] = BurstState(now)
+    if now - burst.window_start > window:
+        burst.window_start = now
+        burst.count = 0
+    burst_on = bool(settings.get("burst_mode", True))
+
+    posted = False
+    # buys found this round, posted together at the end (see _post_buys)
+    pending: List[Tuple[Dict[str, Any], str]] = []
+
+    # STON (STON exported events by blocks)
+    if settings.get("enable_ston", True) and token.get("ston_pool"):
+        pool = token["ston_pool"]
+        try:
+            # a token configured after the shared fetch started isn't in it
+            if ston is not None and pool in ston.pools:
+                from_b, to_b = _ston_window(token, ston.latest)
+                evs = ston.events(pool, from_b, to_b)
+            else:
                 latest = await _to_thread(ston_latest_block)
                 if latest is None:
                     raise RuntimeError("no latest block")
-                # per-token cursor to avoid posting old swaps when a new group configures a token
-                last_block = token.get("ston_last_block")
-                if last_block is None:
-                    # initialize slightly behind to avoid missing
-                    last_block = max(0, int(latest) - 5)
-                from_b = int(last_block) + 1
-                to_b = int(latest)
-                # cap range to avoid huge pulls
-                if to_b - from_b > 60:
-                    from_b = to_b - 60
-                evs = await _to_thread(ston_events, from_b, to_b)
+                from_b, to_b = _ston_window(token, latest)
+                evs = await ston_events_range(from_b, to_b, {pool})
                 if evs is None:
                     raise RuntimeError("ston events fetch failed")
-                # advance cursor only on successful fetch
-                token["ston_last_block"] = to_b
-                # filter swaps for this pool (STON export feed)
-                ton_leg = ensure_ton_leg_for_pool(token)
-                posted_any = False
-                for ev in evs:
-                    if (str(ev.get("eventType") or "").lower() != "swap"):
-                        continue
-                    ignore_before = int(token.get("ignore_before_ts") or 0)
-                    ev_ts = int(ev.get("timestamp") or ev.get("time") or ev.get("ts") or 0)
-                    if ignore_before and ev_ts and ev_ts < ignore_before:
-                        continue
-                    pair_id = str(ev.get("pairId") or "").strip()
-                    if pair_id != pool:
-                        continue
-                    tx = str(ev.get("txnId") or "").strip()
-                    if not tx:
-                        continue
-                    maker = str(ev.get("maker") or "").strip()
-                    a0_in = _to_float(ev.get("amount0In"))
-                    a0_out = _to_float(ev.get("amount0Out"))
-                    a1_in = _to_float(ev.get("amount1In"))
-                    a1_out = _to_float(ev.get("amount1Out"))
-                    ton_spent = 0.0
-                    token_received = 0.0
-                    if ton_leg == 0:
-                        if a0_in > 0 and a1_out > 0:
-                            ton_spent = a0_in
-                            token_received = a1_out
-                        else:
-                            continue
-                    elif ton_leg == 1:
-                        if a1_in > 0 and a0_out > 0:
-                            ton_spent = a1_in
-                            token_received = a0_out
-                        else:
+            # advance cursor only on successful fetch
+            token["ston_last_block"] = to_b
+            # filter swaps for this pool (STON export feed)
+            ton_leg = await ensure_ton_leg_for_pool(token)
+            posted_any = False
+            # Per-token values are loop-invariant; resolve them once, not per event.
+            # A buy is TON in on the TON leg and token out on the other leg.
+            if ton_leg == 0:
+                in_key, out_key = "amount0In", "amount1Out"
+            elif ton_leg == 1:
+                in_key, out_key = "amount1In", "amount0Out"
+            else:
+                in_key = out_key = ""
+            ignore_before = int(token.get("ignore_before_ts") or 0)
+            for ev in (evs if in_key else ()):
+                if (str(ev.get("eventType") or "").lower() != "swap"):
+                    continue
+                ev_ts = int(ev.get("timestamp") or ev.get("time") or ev.get("ts") or 0)
+                if ignore_before and ev_ts and ev_ts < ignore_before:
+                    continue
+                pair_id = str(ev.get("pairId") or "").strip()
+                if pair_id != pool:
+                    continue
+                tx = str(ev.get("txnId") or "").strip()
+                if not tx:
+                    continue
+                ton_spent = _to_float(ev.get(in_key))
+                token_received = _to_float(ev.get(out_key))
+                if ton_spent <= 0 or token_received <= 0:
+                    continue
+                maker = str(ev.get("maker") or "").strip()
+                if ton_spent < min_buy:
+                    continue
+                dedupe_key = f"ston:{pool}:{tx}"
+                if not dedupe_ok(chat_id, dedupe_key):
+                    continue
+                pending.append(({"tx": tx, "buyer": maker, "ton": ton_spent, "token_amount": token_received}, "STON.fi"))
+                posted_any = True
+
+            # Fallback for STON.fi v2 swaps (TonAPI tx actions).
+            # Some v2 pools don't appear in the export feed with matching pairId/fields,
+            # but TonAPI actions still include "Swap tokens" / "Stonfi Swap V2".
+            misses = 0 if posted_any else _STON_MISS.get(chat_id, 0) + 1
+            _STON_MISS[chat_id] = min(misses, STON_FALLBACK_AFTER)
+            if (misses >= STON_FALLBACK_AFTER
+                    and time.time() - _STON_FALLBACK_IDLE.get(pool, 0.0) >= STON_FALLBACK_IDLE_SEC):
+                v2_seen = False  # a buy not posted before: old swaps in the window don't count
+                try:
+                    txs = await _to_thread(tonapi_account_transactions, pool, 15)
+                    # process oldest -> newest
+                    txs = list(reversed(txs))
+                    for txo in txs:
+                        ignore_before = int(token.get("ignore_before_ts") or 0)
+                        ut = int(txo.get("utime") or 0)
+                        if ignore_before and ut and ut < ignore_before:
                             continue
-                    else:
-                        continue
-                    if ton_spent < min_buy:
-                        continue
-                    dedupe_key = f"ston:{pool}:{tx}"
-                    if not dedupe_ok(chat_id, dedupe_key):
-                        continue
-                    if settings.get("burst_mode", True) and burst["count"] >= max_msgs:
-                        continue
-                    burst["count"] += 1
-                    await post_buy(app, chat_id, token, {"tx": tx, "buyer": maker, "ton": ton_spent, "token_amount": token_received}, source="STON.fi")
-                    posted_any = True
-
-                # Fallback for STON.fi v2 swaps (TonAPI tx actions).
-                # Some v2 pools don't appear in the export feed with matching pairId/fields,
-                # but TonAPI actions still include "Swap tokens" / "Stonfi Swap V2".
-                if not posted_any:
-                    try:
-                        txs = await _to_thread(tonapi_account_transactions, pool, 15)
-                        # process oldest -> newest
-                        txs = list(reversed(txs))
-                        for txo in txs:
-                            ignore_before = int(token.get("ignore_before_ts") or 0)
-                            ut = int(txo.get("utime") or 0)
-                            if ignore_before and ut and ut < ignore_before:
-                                continue
-                            buys = stonfi_extract_buys_from_tonapi_tx(txo, token["address"])
-                            for b in buys:
-                                ton_spent = float(b.get("ton") or 0.0)
-                                # TonAPI sometimes returns nanoTON
-                                if ton_spent > 1e5:
-                                    ton_spent = ton_spent / 1e9
-
-                                token_amt = float(b.get("token_amount") or 0.0)
-                                dec = token.get("decimals")
-                                try:
-                                    dec_i = int(dec) if dec is not None else None
-                                except Exception:
-                                    dec_i = None
-                                # TonAPI often returns jetton amount in minimal units
-                                if dec_i is not None and token_amt > 1e8:
-                                    token_amt = token_amt / (10 ** dec_i)
-
-                                if ton_spent < min_buy:
-                                    continue
-                                txh = str(b.get("tx") or "").strip() or _tx_hash(txo)
-                                buyer = str(b.get("buyer") or "").strip()
-                                dedupe_key = f"ston:{pool}:{txh}"
-                                if not dedupe_ok(chat_id, dedupe_key):
-                                    continue
-                                if settings.get("burst_mode", True) and burst["count"] >= max_msgs:
-                                    continue
-                                burst["count"] += 1
-                                await post_buy(app, chat_id, token, {"tx": txh, "buyer": buyer, "ton": ton_spent, "token_amount": token_amt}, source="STON.fi v2")
-                        save_groups()
-                    except Exception as _e:
-                        log.debug("STON v2 fallback err chat=%s %s", chat_id, _e)
-                save_groups()
-            except Exception as e:
-                log.debug("STON poll err chat=%s %s", chat_id, e)
-
-        # DeDust (DeDust API trades)
-        if settings.get("enable_dedust", True) and token.get("dedust_pool"):
-            pool = token["dedust_pool"]
-            try:
-                trades = await _to_thread(dedust_get_trades, pool, 40)
-                if not isinstance(trades, list):
-                    trades = []
-                # Build sortable items with (lt, ts) so ordering is stable regardless of API order.
-                items2 = []
-                for tr in trades:
-                    b = dedust_trade_to_buy(tr, token["address"])
-                    if not b:
-                        continue
-                    # normalize timestamp (ms or sec)
-                    ts_raw = (tr.get("timestamp") or tr.get("time") or tr.get("ts") or 0)
-                    try:
-                        ts_i = int(float(ts_raw or 0))
-                        if ts_i > 10_000_000_000:
-                            ts_i = ts_i // 1000
-                    except Exception:
-                        ts_i = 0
-                    # lt/trade_id (prefer numeric)
-                    lt_raw = (tr.get("lt") or b.get("trade_id") or tr.get("id") or "")
-                    try:
-                        lt_i = int(str(lt_raw).strip()) if str(lt_raw).strip() else 0
-                    except Exception:
-                        lt_i = 0
-                    items2.append((lt_i, ts_i, b, tr))
+                        buys = stonfi_extract_buys_from_tonapi_tx(txo, token["address"])
+                        for b in buys:
+                            dec = token.get("decimals")
+                            try:
+                                dec_i = int(dec) if dec is not None else None
+                            except Exception:
+                                dec_i = None
+                            # TonAPI sometimes returns nanoTON, and often jetton amounts in minimal units
+                            ton_spent, token_amt = _normalize_buy_amounts(
+                                float(b.ton or 0.0), float(b.token_amount or 0.0), dec_i, ton_raw_above=1e5
+                            )
 
-                # sort oldest -> newest
-                items2.sort(key=lambda x: (x[0] or 0, x[1] or 0))
+                            if ton_spent < min_buy:
+                                continue
+                            txh = str(b.tx or "").strip() or _tx_hash(txo)
+                            buyer = str(b.buyer or "").strip()
+                            dedupe_key = f"ston:{pool}:{txh}"
+                            if not dedupe_ok(chat_id, dedupe_key):
+                                continue
+                            pending.append(({"tx": txh, "buyer": buyer, "ton": ton_spent, "token_amount": token_amt}, "STON.fi v2"))
+                            posted_any = v2_seen = True
+                    mark_groups_dirty()
+                except Exception as _e:
+                    log.debug("STON v2 fallback err chat=%s %s", chat_id, _e)
+                if v2_seen:
+                    _STON_FALLBACK_IDLE.pop(pool, None)
+                else:
+                    _STON_MISS[chat_id] = 0
+                    _STON_FALLBACK_IDLE[pool] = time.time()
+            posted = posted or posted_any
+            mark_groups_dirty()
+        except Exception as e:
+            log.debug("STON poll err chat=%s %s", chat_id, e)
 
-                # baselines
-                last_lt = 0
-                last_ts = 0
+    # DeDust (DeDust API trades)
+    if settings.get("enable_dedust", True) and token.get("dedust_pool"):
+        pool = token["dedust_pool"]
+        try:
+            # the trade parsers read decimals via get_jetton_meta; warm its cache off the loop
+            await _to_thread(get_jetton_meta, token["address"])
+            trades = await _to_thread(dedust_get_trades, pool, 40)
+            if not isinstance(trades, list):
+                trades = []
+            # Build sortable items with (lt, ts) so ordering is stable regardless of API order.
+            items2 = []
+            for tr in trades:
+                b = dedust_trade_to_buy(tr, token["address"])
+                if not b:
+                    continue
+                # normalize timestamp (ms or sec)
+                ts_raw = (tr.get("timestamp") or tr.get("time") or tr.get("ts") or 0)
                 try:
-                    last_lt = int(str(token.get("last_dedust_trade") or 0))
+                    ts_i = int(float(ts_raw or 0))
+                    if ts_i > 10_000_000_000:
+                        ts_i = ts_i // 1000
                 except Exception:
-                    last_lt = 0
+                    ts_i = 0
+                # lt/trade_id (prefer numeric)
+                lt_raw = (tr.get("lt") or b.trade_id or tr.get("id") or "")
                 try:
-                    last_ts = int(token.get("last_dedust_ts") or 0)
+                    lt_i = int(str(lt_raw).strip()) if str(lt_raw).strip() else 0
                 except Exception:
-                    last_ts = 0
-
-                ignore_before = int(token.get("ignore_before_ts") or 0)
-
-                posted_any = False
-
-                # If DeDust was enabled later (or group was created before we stored baselines),
-                # set a baseline FIRST and do not post historical trades on the first run.
-                if (last_lt == 0 and last_ts == 0) and items2:
-                    max_lt = max(i[0] for i in items2)
-                    max_ts = max(i[1] for i in items2)
-                    if max_lt:
-                        token["last_dedust_trade"] = str(max_lt)
-                    if max_ts:
-                        token["last_dedust_ts"] = int(max_ts)
-                    if not ignore_before:
-                        token["ignore_before_ts"] = int(time.time())
-                    save_groups()
-                    continue
+                    lt_i = 0
+                items2.append((lt_i, ts_i, b, tr))
 
-                max_seen_lt = last_lt
-                max_seen_ts = last_ts
+            # sort oldest -> newest
+            items2.sort(key=lambda x: (x[0] or 0, x[1] or 0))
 
-                for lt_i, ts_i, b, tr in items2:
-                    # ignore old history right after token added
-                    if ignore_before and ts_i and ts_i < ignore_before:
-                        continue
+            # baselines
+            last_lt = 0
+            last_ts = 0
+            try:
+                last_lt = int(str(token.get("last_dedust_trade") or 0))
+            except Exception:
+                last_lt = 0
+            try:
+                last_ts = int(token.get("last_dedust_ts") or 0)
+            except Exception:
+                last_ts = 0
 
-                    is_new = False
-                    if lt_i and last_lt:
-                        is_new = lt_i > last_lt
-                    elif lt_i and not last_lt:
-                        # If we have lt but no baseline yet, treat as new only if after ignore_before
-                        is_new = True
-                    elif ts_i and last_ts:
-                        is_new = ts_i > last_ts
-                    elif ts_i and not last_ts:
-                        is_new = True
-
-                    if not is_new:
-                        continue
+            ignore_before = int(token.get("ignore_before_ts") or 0)
+
+            posted_any = False
+            baseline_only = False
+
+            # If DeDust was enabled later (or group was created before we stored baselines),
+            # set a baseline FIRST and do not post historical trades on the first run.
+            # No early return: STON buys already collected this round still go out below.
+            if (last_lt == 0 and last_ts == 0) and items2:
+                max_lt = max(i[0] for i in items2)
+                max_ts = max(i[1] for i in items2)
+                if max_lt:
+                    token["last_dedust_trade"] = str(max_lt)
+                if max_ts:
+                    token["last_dedust_ts"] = int(max_ts)
+                if not ignore_before:
+                    token["ignore_before_ts"] = int(time.time())
+                baseline_only = True
+                items2 = []
 
-                    ton_amt = float(b.get("ton") or 0.0)
-                    if ton_amt < min_buy:
-                        continue
+            max_seen_lt = last_lt
+            max_seen_ts = last_ts
 
-                    # unified dedupe by normalized tx hash when possible
-                    txh = _normalize_tx_hash_to_hex(b.get("tx") or "")
-                    dedupe_key = f"tx:{txh}" if txh else f"dedust:{pool}:{b.get('tx')}"
-                    if not dedupe_ok(chat_id, dedupe_key):
-                        continue
-                    if settings.get("burst_mode", True) and burst["count"] >= max_msgs:
-                        continue
-                    burst["count"] += 1
+            for lt_i, ts_i, b, tr in items2:
+                # ignore old history right after token added
+                if ignore_before and ts_i and ts_i < ignore_before:
+                    continue
 
-                    token_amt = float(b.get("token_amount") or 0.0)
-                    await post_buy(app, chat_id, token, {
-                        "tx": b.get("tx"),
-                        "trade_id": str(lt_i or b.get("trade_id") or ""),
-                        "buyer": b.get("buyer"),
-                        "ton": ton_amt,
-                        "token_amount": token_amt,
-                    }, source="DeDust")
+                is_new = False
+                if lt_i and last_lt:
+                    is_new = lt_i > last_lt
+                elif lt_i and not last_lt:
+                    # If we have lt but no baseline yet, treat as new only if after ignore_before
+                    is_new = True
+                elif ts_i and last_ts:
+                    is_new = ts_i > last_ts
+                elif ts_i and not last_ts:
+                    is_new = True
+
+                if not is_new:
+                    continue
 
-                    posted_any = True
+                ton_amt = float(b.ton or 0.0)
+                if ton_amt < min_buy:
+                    continue
 
+                # unified dedupe by normalized tx hash when possible
+                txh = _normalize_tx_hash_to_hex(b.tx or "")
+                dedupe_key = f"tx:{txh}" if txh else f"dedust:{pool}:{b.tx}"
+                if not dedupe_ok(chat_id, dedupe_key):
+                    continue
 
-                    if lt_i and lt_i > max_seen_lt:
-                        max_seen_lt = lt_i
-                    if ts_i and ts_i > max_seen_ts:
-                        max_seen_ts = ts_i
+                token_amt = float(b.token_amount or 0.0)
+                pending.append(({
+                    "tx": b.tx,
+                    "trade_id": str(lt_i or b.trade_id or ""),
+                    "buyer": b.buyer,
+                    "ton": ton_amt,
+                    "token_amount": token_amt,
+                }, "DeDust"))
 
-                # update baselines
-                if max_seen_lt:
-                    token["last_dedust_trade"] = str(max_seen_lt)
-                if max_seen_ts:
-                    token["last_dedust_ts"] = int(max_seen_ts)
+                posted_any = True
 
-                                # TonAPI events fallback (covers DeDust pools where /trades is empty or lagging)
-                if not posted_any:
-                    try:
-                        # Use full /events (subject_only=false) because subject_only can omit
-                        # TonTransfer details needed to calculate TON spent on some DeDust v3 swaps.
-                        events = await _to_thread(tonapi_account_events, pool, 40)
-                        if isinstance(events, list) and events:
-                            last_eid = str(token.get('last_dedust_event_id') or '').strip()
-                            try:
-                                last_ets = int(token.get('last_dedust_event_ts') or 0)
-                            except Exception:
-                                last_ets = 0
-                
-                            # First run baseline (avoid old spam)
-                            if not last_eid and not last_ets:
-                                newest = events[0]
-                                eid0 = str(newest.get('event_id') or newest.get('id') or '').strip()
-                                ts0 = int(newest.get('timestamp') or 0)
-                                if eid0:
-                                    token['last_dedust_event_id'] = eid0
-                                if ts0:
-                                    token['last_dedust_event_ts'] = ts0
-                            else:
-                                new_events = []
-                                for ev in events:
-                                    if not isinstance(ev, dict):
-                                        continue
-                                    eid = str(ev.get('event_id') or ev.get('id') or '').strip()
-                                    ts = int(ev.get('timestamp') or 0)
-                                    if last_eid and eid == last_eid:
-                                        break
-                                    if last_ets and ts and ts <= last_ets:
+
+                if lt_i and lt_i > max_seen_lt:
+                    max_seen_lt = lt_i
+                if ts_i and ts_i > max_seen_ts:
+                    max_seen_ts = ts_i
+
+            # update baselines
+            if max_seen_lt:
+                token["last_dedust_trade"] = str(max_seen_lt)
+            if max_seen_ts:
+                token["last_dedust_ts"] = int(max_seen_ts)
+
+                            # TonAPI events fallback (covers DeDust pools where /trades is empty or lagging)
+            if not posted_any and not baseline_only:
+                try:
+                    # Use full /events (subject_only=false) because subject_only can omit
+                    # TonTransfer details needed to calculate TON spent on some DeDust v3 swaps.
+                    events = await _to_thread(tonapi_account_events, pool, 40)
+                    if isinstance(events, list) and events:
+                        last_eid = str(token.get('last_dedust_event_id') or '').strip()
+                        try:
+                            last_ets = int(token.get('last_dedust_event_ts') or 0)
+                        except Exception:
+                            last_ets = 0
+            
+                        # First run baseline (avoid old spam)
+                        if not last_eid and not last_ets:
+                            newest = events[0]
+                            eid0 = str(newest.get('event_id') or newest.get('id') or '').strip()
+                            ts0 = int(newest.get('timestamp') or 0)
+                            if eid0:
+                                token['last_dedust_event_id'] = eid0
+                            if ts0:
+                                token['last_dedust_event_ts'] = ts0
+                        else:
+                            new_events = []
+                            for ev in events:
+                                if not isinstance(ev, dict):
+                                    continue
+                                eid = str(ev.get('event_id') or ev.get('id') or '').strip()
+                                ts = int(ev.get('timestamp') or 0)
+                                if last_eid and eid == last_eid:
+                                    break
+                                if last_ets and ts and ts <= last_ets:
+                                    continue
+                                if ignore_before and ts and ts < ignore_before:
+                                    continue
+                                new_events.append(ev)
+            
+                            for ev in reversed(new_events):
+                                buys = dedust_buys_from_tonapi_event(ev, token['address'], pool)
+                                for b in buys:
+                                    ton_amt = float(b.get('ton') or 0.0)
+                                    if ton_amt < min_buy:
                                         continue
-                                    if ignore_before and ts and ts < ignore_before:
+                                    txh = _normalize_tx_hash_to_hex(b.get('tx') or '')
+                                    dedupe_key = ('tx:' + txh) if txh else ('dedust:' + str(pool) + ':' + str(b.get('tx')))
+                                    if not dedupe_ok(chat_id, dedupe_key):
                                         continue
-                                    new_events.append(ev)
-                
-                                for ev in reversed(new_events):
-                                    buys = dedust_buys_from_tonapi_event(ev, token['address'], pool)
-                                    for b in buys:
-                                        ton_amt = float(b.get('ton') or 0.0)
-                                        if ton_amt < min_buy:
-                                            continue
-                                        txh = _normalize_tx_hash_to_hex(b.get('tx') or '')
-                                        dedupe_key = ('tx:' + txh) if txh else ('dedust:' + str(pool) + ':' + str(b.get('tx')))
-                                        if not dedupe_ok(chat_id, dedupe_key):
-                                            continue
-                                        if settings.get('burst_mode', True) and burst['count'] >= max_msgs:
-                                            continue
-                                        burst['count'] += 1
-                                        await post_buy(app, chat_id, token, {
-                                            'tx': b.get('tx'),
-                                            'buyer': b.get('buyer'),
-                                            'ton': ton_amt,
-                                            'token_amount': float(b.get('token_amount') or 0.0),
-                                        }, source='DeDust')
-                                        posted_any = True
-                
-                                    eid_new = str(ev.get('event_id') or ev.get('id') or '').strip()
-                                    ts_new = int(ev.get('timestamp') or 0)
-                                    if eid_new:
-                                        token['last_dedust_event_id'] = eid_new
-                                    if ts_new:
-                                        token['last_dedust_event_ts'] = ts_new
-                    except Exception as _e:
-                        log.debug('DeDust TonAPI events fallback err chat=%s %s', chat_id, _e)
-
-                save_groups()
-            except Exception as e:
-                log.debug("DeDust poll err chat=%s %s", chat_id, e)
+                                    pending.append(({
+                                        'tx': b.get('tx'),
+                                        'buyer': b.get('buyer'),
+                                        'ton': ton_amt,
+                                        'token_amount': float(b.get('token_amount') or 0.0),
+                                    }, 'DeDust'))
+                                    posted_any = True
+            
+                                eid_new = str(ev.get('event_id') or ev.get('id') or '').strip()
+                                ts_new = int(ev.get('timestamp') or 0)
+                                if eid_new:
+                                    token['last_dedust_event_id'] = eid_new
+                                if ts_new:
+                                    token['last_dedust_event_ts'] = ts_new
+                except Exception as _e:
+                    log.debug('DeDust TonAPI events fallback err chat=%s %s', chat_id, _e)
+
+            posted = posted or posted_any
+            mark_groups_dirty()
+        except Exception as e:
+            log.debug("DeDust poll err chat=%s %s", chat_id, e)
+
+    if pending:
+        # With burst mode on the round's buys go out as one merged message, so the anti-spam
+        # window counts messages, not buys. Over the cap the round is skipped; its buys are
+        # already marked seen, as before.
+        if burst_on:
+            if burst.count >= max_msgs:
+                log.debug("anti-spam cap reached chat=%s, skipping %d buys", chat_id, len(pending))
+                return posted
+            burst.count += 1
+        await _post_buys(app, chat_id, token, settings, pending)
+    return posted
+
+async def _post_buys(app: Application, chat_id: int, token: Dict[str, Any], settings: Dict[str, Any],
+                     pending: List[Tuple[Dict[str, Any], str]]) -> None:
+    """Post one poll round's buys for a chat.
+
+    With burst mode on, several buys in one round become a single message: the largest
+    buy in full plus a count/total line. Telegram allows about one message per second
+    per group, so posting each of them would only queue up 429s.
+    """
+    if len(pending) == 1 or not settings.get("burst_mode", True):
+        for b, source in pending:
+            await post_buy(app, chat_id, token, b, source=source)
+        return
+    b, source = max(pending, key=lambda p: float(p[0].get("ton") or 0.0))
+    total = sum(float(p[0].get("ton") or 0.0) for p in pending)
+    extra = f"+{len(pending) - 1} more buys ({total:,.2f} TON total)"
+    await post_buy(app, chat_id, token, b, source=source, extra=extra)
 
 
+# Adaptive per-group polling: chat_id -> {"interval": sec, "next": ts}. In memory only;
+# after a restart every group simply starts again at the base rate.
+_POLL_STATE: Dict[str, Dict[str, float]] = {}
 
-    # save seen occasionally
-    save_seen()
+def _note_poll_result(chat_key: str, posted: bool) -> None:
+    """Reset to POLL_INTERVAL after a buy, otherwise stretch the interval 1.5x up to POLL_MAX_INTERVAL."""
+    st = _POLL_STATE.setdefault(chat_key, {"interval": POLL_INTERVAL, "next": 0.0})
+    st["interval"] = POLL_INTERVAL if posted else min(st["interval"] * 1.5, POLL_MAX_INTERVAL)
+    st["next"] = time.time() + st["interval"]
 
-async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dict[str, Any], source: str):
-    sym = (token.get("symbol") or "").strip()
-    name = (token.get("name") or "").strip()
-    title = sym or name or "TOKEN"
+async def poll_once(app: Application):
+    # Collect all groups with configured token
+    items: List[Tuple[int, Dict[str, Any]]] = []
+    now = time.time()
+    for k, g in GROUPS.items():
+        if not isinstance(g, dict):
+            continue
+        token = g.get("token")
+        if not isinstance(token, dict) or token.get("paused", False):
+            continue
+        # nothing to poll: skip before any per-group setup (thresholds, anti-spam window)
+        settings = g.get("settings") or DEFAULT_SETTINGS
+        if not ((settings.get("enable_ston", True) and token.get("ston_pool"))
+                or (settings.get("enable_dedust", True) and token.get("dedust_pool"))):
+            continue
+        # idle groups back off (see _note_poll_result); skip until their next slot
+        if _POLL_STATE.get(k, {}).get("next", 0.0) > now:
+            continue
+        items.append((int(k), g))
 
-    ton_amt = float(b.get("ton") or 0.0)
-    tok_amt = b.get("token_amount")
-    tok_symbol = b.get("token_symbol") or sym or ""
+    try:
+        ston = await _ston_cycle(items)
+    except Exception as e:
+        log.debug("shared STON fetch failed: %s", e)
+        ston = None
 
-    buyer_full = str(b.get("buyer") or "")
-    buyer_short = _short_addr(buyer_full)
-    buyer_url = f"https://tonviewer.com/address/{buyer_full}" if buyer_full else None
-    tx = str(b.get("tx") or "")
+    # Poll groups concurrently (blocking HTTP runs in worker threads); bounded so a
+    # large install does not open a thread/connection per group at once.
+    sem = asyncio.Semaphore(POLL_CONCURRENCY)
 
-    ston_pool = token.get("ston_pool") or ""
-    dedust_pool = token.get("dedust_pool") or ""
-    pool_for_market = ston_pool or dedust_pool
+    async def run(chat_id: int, g: Dict[str, Any]):
+        async with sem:
+            posted = False
+            try:
+                posted = await _poll_group(app, chat_id, g, ston)
+            except Exception as e:
+                log.debug("poll err chat=%s %s", chat_id, e)
+            _note_poll_result(str(chat_id), bool(posted))
+
+    await asyncio.gather(*(run(chat_id, g) for chat_id, g in items))
+
+    # save seen occasionally (DB writes, so off the event loop); most cycles have no new
+    # dedupe keys or LT lookups and no sweep due, so skip the worker-thread hop then
+    if _SEEN_PENDING or _LT_PENDING or time.time() - _SEEN_SWEEP["ts"] >= SEEN_SWEEP_SEC:
+        await _to_thread(save_seen)
+
+# key=pool (or token) -> {ts, price_usd, liq_usd, mc_usd, holders}: the last market snapshot,
+# whose values stand in for lookups that fail (rate limits / temporary errors) for up to
+# MARKET_STALE_SEC. Insertion-ordered and bounded; the oldest snapshot is evicted first.
+MARKET_CACHE: Dict[str, Dict[str, Any]] = {}
+MARKET_CACHE_MAX = 4096
+MARKET_STALE_SEC = 900
+# key -> future of the in-flight market fetch (singleflight)
+_market_inflight: Dict[str, asyncio.Future] = {}
+
+async def get_market(pool: str, jetton_addr: str) -> Dict[str, Any]:
+    """Price, liquidity, market cap and holders for a buy alert.
+
+    A burst of buys on one pool (or several groups tracking it) shares a single fetch;
+    later callers await the first one.
+    """
+    key = str(pool or jetton_addr).strip()
+    fut = _market_inflight.get(key) if key else None
+    if fut is not None:
+        # shielded: a cancelled follower must not cancel the shared future for everyone
+        return await asyncio.shield(fut)
+    if key:
+        fut = _market_inflight[key] = asyncio.get_running_loop().create_future()
+    market: Dict[str, Any] = {"price_usd": None, "liq_usd": None, "mc_usd": None, "holders": None}
+    try:
+        market = await _fetch_market(key, pool, jetton_addr)
+    except Exception as e:
+        log.debug("market fetch failed for %s: %s", key, e)
+    finally:
+        if fut is not None:
+            _market_inflight.pop(key, None)
+            if not fut.done():
+                fut.set_result(market)
+    return market
+
+async def _fetch_market(key: str, pool: str, jetton_addr: str) -> Dict[str, Any]:
+    async def _none():
+        return None
+    # The pool's market data and the jetton info (holders) are independent lookups, so
+    # they run together; a failing one just counts as empty.
+    pinfo, info = (
+        None if isinstance(r, Exception) else r
+        for r in await asyncio.gather(
+            _to_thread(gecko_pool_info, pool) if pool else _none(),
+            _to_thread(tonapi_jetton_info, jetton_addr) if jetton_addr else _none(),
+            return_exceptions=True,
+        )
+    )
 
     # Market data (prefer GeckoTerminal)
-    price_usd = liq_usd = mc_usd = None
-    # Try cache first to avoid missing stats (rate limits / temporary failures)
-    market_cache_key = str(pool_for_market or token_addr or "").strip()
-    _mcached = MARKET_CACHE.get(market_cache_key) if market_cache_key else None
-    _now = int(time.time())
-    if _mcached and _now - int(_mcached.get("ts") or 0) < 900:
-        price_usd = _mcached.get("price_usd")
-        liq_usd = _mcached.get("liq_usd")
-        mc_usd = _mcached.get("mc_usd")
-    if pool_for_market:
-        pinfo = gecko_pool_info(pool_for_market)
-        if pinfo:
-            try:
-                price_usd = float(pinfo.get("price_usd")) if pinfo.get("price_usd") is not None else None
-            except Exception:
-                price_usd = None
-            try:
-                liq_usd = float(pinfo.get("liquidity_usd")) if pinfo.get("liquidity_usd") is not None else None
-            except Exception:
-                liq_usd = None
-            try:
-                mc_usd = float(pinfo.get("market_cap_usd")) if pinfo.get("market_cap_usd") is not None else None
-            except Exception:
-                mc_usd = None
+    price_usd = liq_usd = mc_usd = holders = None
+    # Start from the last snapshot to avoid missing stats (rate limits / temporary failures)
+    cached = MARKET_CACHE.get(key) if key else None
+    if cached and int(time.time()) - int(cached.get("ts") or 0) < MARKET_STALE_SEC:
+        price_usd = cached.get("price_usd")
+        liq_usd = cached.get("liq_usd")
+        mc_usd = cached.get("mc_usd")
+        holders = cached.get("holders")
+    if pinfo:
+        try:
+            price_usd = float(pinfo.get("price_usd")) if pinfo.get("price_usd") is not None else None
+        except Exception:
+            price_usd = None
+        try:
+            liq_usd = float(pinfo.get("liquidity_usd")) if pinfo.get("liquidity_usd") is not None else None
+        except Exception:
+            liq_usd = None
+        try:
+            mc_usd = float(pinfo.get("market_cap_usd")) if pinfo.get("market_cap_usd") is not None else None
+        except Exception:
+            mc_usd = None
 
-    if (price_usd is None or mc_usd is None) and token.get("address"):
-        tinfo = gecko_token_info(token["address"])
+    # only needed when the pool didn't carry price/market cap, so not fetched up front
+    if (price_usd is None or mc_usd is None) and jetton_addr:
+        tinfo = await _to_thread(gecko_token_info, jetton_addr)
         if tinfo:
             if price_usd is None:
                 try:
@@ -2882,49 +4024,63 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
                 except Exception:
                     pass
 
-    # Holders (keep last known value if APIs fail)
-    holders = None
-    try:
-        if token.get("holders") is not None:
-            holders = int(token.get("holders"))
-    except Exception:
-        holders = None
-
-    jetton_addr = str(token.get("address") or "").strip()
     if jetton_addr:
         # TonAPI Jetton info sometimes includes holders_count. If not, fall back
         # to the dedicated holders endpoint.
         try:
-            info = tonapi_jetton_info(jetton_addr)
-            h = info.get("holders_count")
+            h = (info or {}).get("holders_count")
             if h is not None:
                 holders = int(h)
         except Exception:
             pass
         if holders is None:
             try:
-                h2 = tonapi_jetton_holders_count(jetton_addr)
+                h2 = await _to_thread(tonapi_jetton_holders_count, jetton_addr)
                 if h2 is not None:
                     holders = int(h2)
             except Exception:
                 pass
 
-    # Persist latest known holders so the field doesn't disappear in later buys.
-    if holders is not None:
-        try:
-            token["holders"] = int(holders)
-        except Exception:
-            pass
+    market = {"price_usd": price_usd, "liq_usd": liq_usd, "mc_usd": mc_usd, "holders": holders}
+    # Store/refresh the snapshot so later messages don't lose stats
+    if key:
+        MARKET_CACHE.pop(key, None)
+        if len(MARKET_CACHE) >= MARKET_CACHE_MAX:
+            MARKET_CACHE.pop(next(iter(MARKET_CACHE)), None)
+        MARKET_CACHE[key] = {"ts": int(time.time()), **market}
+    return market
 
-    # Store/refresh cache so later messages don't lose stats
-    if market_cache_key:
-        MARKET_CACHE[market_cache_key] = {
-            "ts": int(time.time()),
-            "price_usd": price_usd,
-            "liq_usd": liq_usd,
-            "mc_usd": mc_usd,
-            "holders": holders,
-        }
+async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dict[str, Any], source: str, extra: str = ""):
+    sym = (token.get("symbol") or "").strip()
+    name = (token.get("name") or "").strip()
+    title = sym or name or "TOKEN"
+
+    ton_amt = float(b.get("ton") or 0.0)
+    tok_amt = b.get("token_amount")
+    tok_symbol = b.get("token_symbol") or sym or ""
+
+    buyer_full = str(b.get("buyer") or "")
+    buyer_short = _short_addr(buyer_full)
+    buyer_url = f"https://tonviewer.com/address/{buyer_full}" if buyer_full else None
+    tx = str(b.get("tx") or "")
+
+    ston_pool = token.get("ston_pool") or ""
+    dedust_pool = token.get("dedust_pool") or ""
+    pool_for_market = ston_pool or dedust_pool
+    jetton_addr = str(token.get("address") or "").strip()
+
+    market = await get_market(pool_for_market, jetton_addr)
+    price_usd, liq_usd, mc_usd = market["price_usd"], market["liq_usd"], market["mc_usd"]
+    # Holders (keep last known value if APIs fail), persisted so the field doesn't
+    # disappear in later buys.
+    holders = market["holders"]
+    try:
+        if holders is not None:
+            token["holders"] = int(holders)
+        elif token.get("holders") is not None:
+            holders = int(token.get("holders"))
+    except Exception:
+        holders = None
 
     # Links row
     pair_for_links = pool_for_market or ""
@@ -2933,15 +4089,12 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
     if not tx_hex and source == "DeDust":
         lt_guess = str(b.get("trade_id") or tx or "").strip()
         if lt_guess:
-            resolved = tonapi_find_tx_hash_by_lt(str(dedust_pool or ""), lt_guess, limit=300)
+            resolved = await _to_thread(tonapi_find_tx_hash_by_lt, str(dedust_pool or ""), lt_guess, limit=300)
             if not resolved:
                 # quick retries for busy pools
                 for _ in range(3):
-                    try:
-                        time.sleep(0.35)
-                    except Exception:
-                        pass
-                    resolved = tonapi_find_tx_hash_by_lt(str(dedust_pool or ""), lt_guess, limit=600)
+                    await asyncio.sleep(0.35)
+                    resolved = await _to_thread(tonapi_find_tx_hash_by_lt, str(dedust_pool or ""), lt_guess, limit=600)
                     if resolved:
                         break
             tx_hex = _normalize_tx_hash_to_hex(resolved) or tx_hex
@@ -3000,7 +4153,7 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
 
     lines: List[str] = []
     # Header similar to Crypton
-    lines.append(f"*{html.escape(title)} Buy!*")
+    lines.append(f"*{_md(title)} Buy!*")
     if strength_block:
         lines.append(strength_block)
     lines.append("")
@@ -3008,9 +4161,9 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
     if tok_amt and tok_symbol:
         try:
             tok_amt_f = float(tok_amt)
-            lines.append(f"Got: *{fmt_token_amount(tok_amt_f)} {html.escape(str(tok_symbol))}*")
+            lines.append(f"Got: *{fmt_token_amount(tok_amt_f)} {_md(tok_symbol)}*")
         except Exception:
-            lines.append(f"Got: *{html.escape(str(tok_amt))} {html.escape(str(tok_symbol))}*")
+            lines.append(f"Got: *{_md(tok_amt)} {_md(tok_symbol)}*")
     lines.append("")
     # Buyer wallet clickable + Txn label next to it (Crypton-style)
     if buyer_url:
@@ -3032,6 +4185,9 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
     if bool(s.get("show_holders", True)):
         lines.append(f"Holders: {holders if holders is not None else '—'}")
 
+    if extra:
+        lines.append(extra)
+
     lines.append("")
     # Keep only TX | GT | DexS | Telegram | Trending
     link_parts: List[str] = []
@@ -3051,9 +4207,8 @@ async def post_buy(app: Application, chat_id: int, token: Dict[str, Any], b: Dic
     msg = "\n".join(lines)
 
     # Single buy button (dTrade referral + CA)
-    ref = (DTRADE_REF or "https://t.me/dtrade?start=11TYq7LInG").rstrip("_")
     ca = token.get("address") or ""
-    buy_url = f"{ref}_{ca}" if ca else ref
+    buy_url = DTRADE_BUY_PREFIX + ca if ca else DTRADE_BUY_BASE
     kb = InlineKeyboardMarkup([[InlineKeyboardButton(f"Buy {sym or 'Token'} with dTrade", url=buy_url)]])
 
     # If buy image enabled and a Telegram file_id is set, send a photo with caption (not a link).
@@ -3103,6 +4258,8 @@ async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new = my_chat_member.new_chat_member
         if chat.type not in ("group","supergroup"):
             return
+        # the bot's own rights changed; re-read the admin list on the next check
+        _ADMIN_SETS.pop(chat.id, None)
         if new and new.status in ("member","administrator"):
             kb = InlineKeyboardMarkup([
                 [InlineKeyboardButton("⚙️ Configure Token", callback_data="CFG_GROUP")],
@@ -3117,40 +4274,68 @@ async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=kb,
                 parse_mode="Markdown"
             )
-    except Exception:
-        return
+    except TelegramError as e:
+        log.warning("on_chat_member: intro to %s failed: %s", update.effective_chat.id if update.effective_chat else "?", e)
 
 # -------------------- HEALTH SERVER --------------------
 app_flask = Flask(__name__)
+# Prometheus scrape endpoint next to the health route
+app_flask.wsgi_app = DispatcherMiddleware(app_flask.wsgi_app, {"/metrics": make_wsgi_app()})
 
 @app_flask.get("/")
 def health():
     return "ok", 200
 
-def run_flask():
-    port = int(os.getenv("PORT", "8080"))
+def run_flask(port: Optional[int] = None):
+    port = port or int(os.getenv("PORT", "8080"))
     app_flask.run(host="0.0.0.0", port=port)
 
 # -------------------- MAIN --------------------
 async def post_init(app: Application):
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="http")
+    )
     # start tracker
     app.create_task(tracker_loop(app))
+    app.create_task(groups_flusher())
     log.info("Tracker started.")
 
+async def post_shutdown(app: Application):
+    # write whatever the flusher / last poll had not picked up yet
+    save_groups()
+    _flush_lt_hashes()
+
 def main():
     if not BOT_TOKEN:
         raise SystemExit("BOT_TOKEN is missing.")
-    application = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).build()
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    application = ApplicationBuilder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler("start", start_cmd))
-    application.add_handler(CallbackQueryHandler(on_replace_button, pattern=r"^(REPL_|CANCEL_REPL$)"))
+    application.add_handler(CallbackQueryHandler(on_replace_button, pattern=r"^(REPL_|CANCEL_REPL)"))
     application.add_handler(CallbackQueryHandler(on_button))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
+    if WEBHOOK_URL:
+        # Telegram pushes updates to PORT, so health/metrics move to HEALTH_PORT (if set).
+        health_port = int(os.getenv("HEALTH_PORT", "0") or 0)
+        if health_port:
+            threading.Thread(target=run_flask, args=(health_port,), daemon=True).start()
+        log.info("SpyTON Public BuyBot starting (webhook)...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8080")),
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=True,
+        )
+        return
+
     # flask in thread for Railway health
-    import threading
     threading.Thread(target=run_flask, daemon=True).start()
 
     log.info("SpyTON Public BuyBot starting...")